@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+
+import Queue
+import argparse
+import gzip
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+from qpid import messaging as qm
+from whelk import shell
+
+from ingestion import Ingestor
+from ingestion.backpressure import QmfQueueDepths, QUEUE_OBJECT_NAME
+from ingestion.edex_logs import FINISHED_PROCESSING, LogReader, parse_line
+from ingestion.processed_logs import ProcessedLog, write_processed_log
+
+parser = argparse.ArgumentParser(description="Benchmark parts of the ingestion script.")
+subparsers = parser.add_subparsers(dest="benchmark")
+
+# Log Parser (log_parser)
+parser_log_parser = subparsers.add_parser('log_parser',
+                                          help="Compare the EDEX log parser with the zgrep pipeline.")
+parser_log_parser.add_argument('--size', type=int, default=2048, metavar="MB",
+                               help="Size of the synthetic EDEX log in megabytes.")
+parser_log_parser.add_argument('--ratio', type=int, default=20, metavar="N",
+                               help="Write a Finished Processing file line for every N log lines.")
+parser_log_parser.add_argument('--gzip', action='store_true',
+                               help="Also compare on a gzip compressed copy of the log.")
+parser_log_parser.add_argument('--path', default=None, metavar="directory",
+                               help="Where to write the synthetic log (a temporary directory by default).")
+
+# Processed Log (processed_log)
+parser_processed_log = subparsers.add_parser('processed_log',
+                                             help="Compare the compact processed log format with plain text.")
+parser_processed_log.add_argument('--entries', type=int, default=1000000, metavar="N",
+                                  help="Number of entries in the synthetic processed log.")
+parser_processed_log.add_argument('--lookups', type=int, default=10000, metavar="N",
+                                  help="Number of lookups to time.")
+parser_processed_log.add_argument('--path', default=None, metavar="directory",
+                                  help="Where to write the processed logs (a temporary directory by default).")
+
+# Engines (engines)
+parser_engines = subparsers.add_parser('engines',
+                                       help="Compare the process and thread engines on sends that wait on QPID.")
+parser_engines.add_argument('--batches', type=int, default=20, metavar="N",
+                            help="Number of batches to send.")
+parser_engines.add_argument('--files', type=int, default=100, metavar="N",
+                            help="Number of files in each batch.")
+parser_engines.add_argument('--latency', type=int, default=20, metavar="ms",
+                            help="How long each send waits for the (simulated) QPID server.")
+parser_engines.add_argument('--processes', type=int, default=4, metavar="N",
+                            help="Number of processes the process engine sends from.")
+parser_engines.add_argument('--threads', type=int, default=100, metavar="N",
+                            help="Number of threads the thread engine sends from.")
+parser_engines.add_argument('--skew', action='store_true',
+                            help="Put as many files in the first batch as in all the others together.")
+parser_engines.add_argument('--chunk', type=int, default=None, metavar="N",
+                            help="Split the batches into chunks of N files that idle workers can take.")
+
+# Backpressure (backpressure)
+parser_backpressure = subparsers.add_parser('backpressure',
+                                            help="Send to a stand-in broker whose queues drain slower than they are filled, pausing on QMF queue depths.")
+parser_backpressure.add_argument('--files', type=int, default=2000, metavar="N",
+                                 help="Number of files to send to each route.")
+parser_backpressure.add_argument('--routes', type=int, default=4, metavar="N",
+                                 help="Number of routes (and queues) to send to.")
+parser_backpressure.add_argument('--drain', type=int, default=250, metavar="N",
+                                 help="How many messages per second EDEX takes off each queue.")
+parser_backpressure.add_argument('--high_watermark', type=int, default=500, metavar="N",
+                                 help="Pause sending to a route while its queue holds N or more messages.")
+parser_backpressure.add_argument('--low_watermark', type=int, default=None, metavar="N",
+                                 help="Resume sending to a paused route once its queue holds N messages or fewer.")
+parser_backpressure.add_argument('--interval', type=float, default=1, metavar="seconds",
+                                 help="How often queue depths are polled.")
+parser_backpressure.add_argument('--latency', type=int, default=1, metavar="ms",
+                                 help="How long each send waits for the stand-in broker.")
+
+FINISHED_LINE = (
+    "INFO  2016-10-17 %02d:%02d:%02d,%03d [Ingest.ctdbp-cdef-dcl_telemetered-%d] "
+    "IngestProcessor: EDEX - " + FINISHED_PROCESSING + " "
+    "/omc_data/whoi/OMC/CE01ISSM/D%05d/dcl17/ctdbp1/%08d.ctdbp1.log\n")
+OTHER_LINE = (
+    "INFO  2016-10-17 %02d:%02d:%02d,%03d [Ingest.ctdbp-cdef-dcl_telemetered-%d] "
+    "Ingest: EDEX: Ingest - ctdbp-cdef-dcl:: /omc_data/whoi/OMC/CE01ISSM/D%05d/dcl17/ctdbp1/"
+    "%08d.ctdbp1.log processed in: 0.0123 (sec) Latency: 0.0456 (sec)\n")
+
+
+class LatencySender(object):
+    """ Stands in for a QpidSender, waiting latency seconds for each message as if for the QPID
+        server. """
+
+    window = None
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.RLock()
+
+    def send(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return []
+
+    def sync(self):
+        return []
+
+    def disconnect(self):
+        pass
+
+
+class BenchmarkServices(object):
+    """ Stands in for the ServiceManager, reporting the EDEX services as always healthy. """
+
+    def refresh_status(self):
+        return True
+
+    def healthy(self):
+        return True
+
+
+class BenchmarkIngestor(Ingestor):
+    """ An Ingestor whose messages go to LatencySenders instead of QPID. """
+
+    def get_qpid_sender(self, route):
+        return self.qpid_senders.setdefault(route, LatencySender(self.latency))
+
+
+class StandInBroker(object):
+    """ Stands in for the QPID broker and its QMF management agent. Messages sent to a route are
+        added to the route's queue, which EDEX drains at drain messages per second, and QMF
+        queries for a queue are answered with its depth. """
+
+    def __init__(self, drain):
+        self.drain = drain
+        self.lock = threading.Lock()
+        self.depths = {}
+        self.peaks = {}
+        self.updated = time.time()
+        self.queries = 0
+
+    def settle(self):
+        """ Take the messages EDEX has consumed since the last settle off every queue. """
+        now = time.time()
+        consumed = (now - self.updated) * self.drain
+        self.depths = dict((q, max(d - consumed, 0)) for q, d in self.depths.iteritems())
+        self.updated = now
+
+    def enqueue(self, queue):
+        with self.lock:
+            self.settle()
+            self.depths[queue] = self.depths.get(queue, 0) + 1
+            self.peaks[queue] = max(self.peaks.get(queue, 0), self.depths[queue])
+
+    def respond(self, request):
+        """ Answer a QMF query request for a queue object like the broker's agent does. """
+        if (request.properties.get('qmf.opcode') != '_query_request'
+                or request.content.get('_what') != 'OBJECT'):
+            raise qm.exceptions.MessagingError(text="Not a QMF object query: %r" % request)
+        name = request.content['_object_id']['_object_name']
+        queue = name[len(QUEUE_OBJECT_NAME % ""):]
+        with self.lock:
+            self.settle()
+            self.queries += 1
+            content = []
+            if queue in self.depths:
+                content = [{'_values': {'name': queue, 'msgDepth': int(self.depths[queue])}}]
+        return qm.Message(
+            content, correlation_id=request.correlation_id, subject='broker',
+            properties={'qmf.opcode': '_query_response'})
+
+
+class StandInSession(object):
+    """ A session on the StandInBroker, with just what QmfQueueDepths uses. """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.responses = Queue.Queue()
+
+    def sender(self, address):
+        return StandInQmfSender(self)
+
+    def receiver(self, address):
+        return StandInQmfReceiver(self)
+
+    def acknowledge(self, message):
+        pass
+
+
+class StandInQmfSender(object):
+
+    def __init__(self, session):
+        self.session = session
+
+    def send(self, message):
+        self.session.responses.put(self.session.broker.respond(message))
+
+
+class StandInQmfReceiver(object):
+
+    def __init__(self, session):
+        self.session = session
+
+    def fetch(self, timeout=None):
+        try:
+            return self.session.responses.get(timeout=timeout)
+        except Queue.Empty:
+            raise qm.exceptions.Empty()
+
+
+class StandInConnection(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def session(self):
+        return StandInSession(self.broker)
+
+    def close(self, timeout=None):
+        pass
+
+
+class StandInQueueDepths(QmfQueueDepths):
+    """ Reads queue depths with QMF queries answered by a StandInBroker. """
+
+    def __init__(self, broker):
+        super(StandInQueueDepths, self).__init__()
+        self.broker = broker
+
+    def open_connection(self):
+        return StandInConnection(self.broker)
+
+
+class BrokerSender(LatencySender):
+    """ Stands in for a QpidSender, adding each message to its route's queue on the broker after
+        waiting latency seconds. """
+
+    def __init__(self, broker, address, latency):
+        super(BrokerSender, self).__init__(latency)
+        self.broker = broker
+        self.address = address
+
+    def send(self, *args, **kwargs):
+        time.sleep(self.latency)
+        self.broker.enqueue(self.address)
+        return []
+
+
+class BackpressureIngestor(Ingestor):
+    """ An Ingestor whose messages go to a StandInBroker instead of QPID. """
+
+    def get_qpid_sender(self, route):
+        return self.qpid_senders.setdefault(
+            route, BrokerSender(self.broker, route, self.latency))
+
+
+class Benchmark(object):
+    """ A helper class that runs the individual benchmarks and logs their results. """
+
+    def __init__(self, args):
+        self.logger = logging.getLogger('Benchmark')
+        self.args = args
+
+    def execute(self):
+        getattr(self, self.args.benchmark)()
+
+    def check_sent(self, ingestor):
+        """ Exit with an error if any files failed to send, rather than report their timings. """
+        if ingestor.failed_ingestions:
+            self.logger.error("%s files failed to send." % len(ingestor.failed_ingestions))
+            sys.exit(1)
+
+    def timed(self, label, function, *args):
+        """ Run the function, log how long it took and return its result. """
+        start_time = time.time()
+        result = function(*args)
+        time_elapsed = time.time() - start_time
+        self.logger.info("%-40s %8.2f seconds" % (label, time_elapsed))
+        return result
+
+    def write_synthetic_log(self, log_file):
+        """ Write a synthetic EDEX log of the requested size, where one in every ratio lines is a
+            Finished Processing file line. """
+        size = self.args.size * 1024 * 1024
+        written = 0
+        n = 0
+        with open(log_file, "w") as outfile:
+            while written < size:
+                lines = []
+                for i in range(n, n + 10000):
+                    template = FINISHED_LINE if i % self.args.ratio == 0 else OTHER_LINE
+                    lines.append(template % (
+                        i / 3600000 % 24, i / 60000 % 60, i / 1000 % 60, i % 1000, i % 16,
+                        i % 10 + 1, i))
+                block = "".join(lines)
+                outfile.write(block)
+                written += len(block)
+                n += 10000
+        return n / self.args.ratio
+
+    def log_parser(self):
+        """ Compare the EDEX log parser against the zgrep pipeline that used to pre-process the
+            EDEX logs, extracting (timestamp, uframe_route, filename) records from a synthetic log.
+            """
+        def grep_records(log_file):
+            output = shell.zgrep(FINISHED_PROCESSING, log_file)[1]
+            return len([r for r in (parse_line(l) for l in output.splitlines()) if r])
+
+        def reader_records(log_file):
+            return len(list(LogReader(log_file).records()))
+
+        directory = self.args.path or tempfile.mkdtemp()
+        log_file = "/".join((directory, "edex-ooi-benchmark.log"))
+        try:
+            self.logger.info("Writing a %s MB synthetic EDEX log to %s." % (self.args.size, log_file))
+            expected = self.timed("Write synthetic log", self.write_synthetic_log, log_file)
+            log_files = [log_file]
+            if self.args.gzip:
+                with open(log_file, "rb") as infile:
+                    with gzip.open(log_file + ".gz", "wb") as outfile:
+                        self.timed("Write gzip compressed copy", shutil.copyfileobj, infile, outfile)
+                log_files.append(log_file + ".gz")
+
+            for f in log_files:
+                self.logger.info('')
+                self.logger.info("%s (%.1f MB, %s records)" % (
+                    f, os.path.getsize(f) / 1024.0 / 1024.0, expected))
+                for label, function in (
+                        ("zgrep pipeline", grep_records), ("LogReader", reader_records)):
+                    found = self.timed(label, function, f)
+                    if found != expected:
+                        self.logger.error("%s found %s of %s records." % (label, found, expected))
+        finally:
+            for f in (log_file, log_file + ".gz"):
+                if os.path.exists(f):
+                    os.remove(f)
+            if not self.args.path:
+                os.rmdir(directory)
+
+    def processed_log(self):
+        """ Compare the size of a processed log and the time it takes to look files up in it
+            between the compact format and the plain text lines it replaced. """
+        directory = self.args.path or tempfile.mkdtemp()
+        text_file = "/".join((directory, "edex-ooi-benchmark.log.txt"))
+        compact_file = "/".join((directory, "edex-ooi-benchmark.log.p"))
+        lines = [FINISHED_LINE % (
+            i / 3600000 % 24, i / 60000 % 60, i / 1000 % 60, i % 1000, i % 16, i % 10 + 1, i)
+            for i in range(self.args.entries)]
+        try:
+            with open(text_file, "w") as outfile:
+                outfile.writelines(lines)
+            records = [parse_line(l) for l in lines]
+            self.timed("Write compact processed log", write_processed_log, compact_file, records)
+            self.logger.info("%-40s %8.1f MB" % (
+                "Plain text size", os.path.getsize(text_file) / 1024.0 / 1024.0))
+            self.logger.info("%-40s %8.1f MB" % (
+                "Compact size", os.path.getsize(compact_file) / 1024.0 / 1024.0))
+
+            step = max(len(records) / self.args.lookups, 1)
+            lookups = [(route, filename) for timestamp, route, filename in records[::step]]
+            processed_log = ProcessedLog(compact_file)
+            start_time = time.time()
+            found = len([l for l in lookups if processed_log.contains(*l)])
+            time_elapsed = time.time() - start_time
+            processed_log.close()
+            self.logger.info("%-40s %8.2f microseconds" % (
+                "Compact lookup", time_elapsed / len(lookups) * 1000000))
+            if found != len(lookups):
+                self.logger.error("Compact lookups found %s of %s files." % (found, len(lookups)))
+
+            start_time = time.time()
+            for route, filename in lookups[:10]:
+                shell.grep("-m1", "%s.*%s" % (route, filename), text_file)
+            self.logger.info("%-40s %8.2f microseconds" % (
+                "Plain text grep lookup", (time.time() - start_time) / 10 * 1000000))
+        finally:
+            for f in (text_file, compact_file):
+                if os.path.exists(f):
+                    os.remove(f)
+            if not self.args.path:
+                os.rmdir(directory)
+
+    def engines(self):
+        """ Compare the wall clock time, CPU time and peak memory of the process (billiard) and
+            thread engines sending synthetic batches, each send waiting on a simulated QPID. """
+        def cpu_time():
+            usage = [
+                resource.getrusage(r) for r in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+            return sum(u.ru_utime + u.ru_stime for u in usage)
+
+        def sample_memory(peak, done):
+            process = psutil.Process(os.getpid())
+            while not done.wait(0.05):
+                try:
+                    rss = sum(
+                        p.memory_info().rss
+                        for p in [process] + process.children(recursive=True))
+                except psutil.Error:
+                    continue
+                peak[0] = max(peak[0], rss)
+
+        routes = [{
+            'uframe_route': "Ingest.ctdbp-cdef-dcl_telemetered-%d" % i,
+            'reference_designator': "CE01ISSM-MFD37-03-CTDBPC000",
+            'data_source': "telemetered",
+            } for i in range(4)]
+        sizes = [self.args.files] * self.args.batches
+        if self.args.skew:
+            sizes[0] = self.args.files * (self.args.batches - 1)
+        batches = [{
+            'mask': "/omc_data/whoi/OMC/CE01ISSM/D%05d/dcl17/ctdbp1/*.ctdbp1.log" % b,
+            'deployment_number': "1",
+            'files': [(
+                "/omc_data/whoi/OMC/CE01ISSM/D%05d/dcl17/ctdbp1/%08d.ctdbp1.log" % (b, f),
+                [routes[b % len(routes)]]) for f in range(size)],
+            } for b, size in enumerate(sizes)]
+        messages = sum(sizes)
+
+        # MAX_CONCURRENT_JOBS and the (absent) rate limits are read from jobs.yml in the working
+        # directory.
+        directory = tempfile.mkdtemp()
+        working_directory = os.getcwd()
+        for name in ('Ingestor', 'QPID', 'Health'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+        try:
+            os.chdir(directory)
+            with open("jobs.yml", "w") as outfile:
+                outfile.write("MAX_CONCURRENT_JOBS: %s\n" % self.args.processes)
+
+            self.logger.info("Sending %s batches of %s files, waiting %s ms for each send." % (
+                self.args.batches, "up to %s" % max(sizes) if self.args.skew else self.args.files,
+                self.args.latency))
+            if self.args.chunk:
+                self.logger.info("Idle workers take chunks of %s files from busy ones." % (
+                    self.args.chunk))
+            for engine, concurrency in (
+                    ("process", min(self.args.processes, self.args.batches)),
+                    ("thread", min(self.args.threads, self.args.batches))):
+                ingestor = BenchmarkIngestor(
+                    force_mode=True, no_edex=True, engine=engine, threads=self.args.threads,
+                    chunk_size=self.args.chunk, ordered=not self.args.chunk,
+                    service_manager=BenchmarkServices())
+                ingestor.latency = self.args.latency / 1000.0
+                for batch in batches:
+                    ingestor.queue.append(batch)
+
+                peak, done = [0], threading.Event()
+                sampler = threading.Thread(target=sample_memory, args=(peak, done))
+                sampler.start()
+                start_cpu_time, start_time = cpu_time(), time.time()
+                ingestor.ingest_from_queue()
+                time_elapsed = time.time() - start_time
+                cpu_time_elapsed = cpu_time() - start_cpu_time
+                done.set()
+                sampler.join()
+                self.check_sent(ingestor)
+
+                self.logger.info('')
+                self.logger.info("%s engine (%s concurrent sends)" % (engine.title(), concurrency))
+                self.logger.info("%-40s %8.2f seconds" % ("Wall clock time", time_elapsed))
+                self.logger.info("%-40s %8.1f messages/second" % (
+                    "Throughput", messages / time_elapsed))
+                self.logger.info("%-40s %8.2f seconds" % ("CPU time", cpu_time_elapsed))
+                self.logger.info("%-40s %8.2f ms/1000 messages" % (
+                    "CPU time per message", cpu_time_elapsed / messages * 1000000))
+                self.logger.info("%-40s %8.1f MB" % ("Peak memory", peak[0] / 1024.0 / 1024.0))
+                self.logger.info("%-40s %8.2f MB/(message/second)" % (
+                    "Peak memory per throughput",
+                    peak[0] / 1024.0 / 1024.0 / (messages / time_elapsed)))
+        finally:
+            os.chdir(working_directory)
+            shutil.rmtree(directory)
+
+    def backpressure(self):
+        """ Send to routes whose stand-in broker queues drain slower than they fill, reading
+            their depths through the real QMF query path, and check that sending pauses. """
+        broker = StandInBroker(self.args.drain)
+        routes = [{
+            'uframe_route': "Ingest.ctdbp-cdef-dcl_telemetered-%d" % i,
+            'reference_designator': "CE01ISSM-MFD37-03-CTDBPC000",
+            'data_source': "telemetered",
+            } for i in range(self.args.routes)]
+
+        directory = tempfile.mkdtemp()
+        working_directory = os.getcwd()
+        for name in ('Ingestor', 'QPID', 'Health', 'Backpressure'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+        try:
+            os.chdir(directory)
+            queue_depths = StandInQueueDepths(broker)
+            ingestor = BackpressureIngestor(
+                force_mode=True, no_edex=True, engine="thread", threads=len(routes),
+                high_watermark=self.args.high_watermark, low_watermark=self.args.low_watermark,
+                queue_depths=queue_depths, service_manager=BenchmarkServices())
+            ingestor.broker = broker
+            ingestor.latency = self.args.latency / 1000.0
+            ingestor.backpressure.interval = self.args.interval
+            for i, r in enumerate(routes):
+                ingestor.queue.append({
+                    'mask': "/omc_data/whoi/OMC/CE01ISSM/D%05d/dcl17/ctdbp1/*.ctdbp1.log" % i,
+                    'deployment_number': "1",
+                    'files': [(
+                        "/omc_data/whoi/OMC/CE01ISSM/D%05d/dcl17/ctdbp1/%08d.ctdbp1.log" % (i, f),
+                        [r]) for f in range(self.args.files)],
+                    })
+
+            self.logger.info((
+                "Sending %s files to each of %s routes, with EDEX draining %s messages/second "
+                "from each queue.") % (self.args.files, len(routes), self.args.drain))
+            start_time = time.time()
+            ingestor.ingest_from_queue()
+            time_elapsed = time.time() - start_time
+            self.check_sent(ingestor)
+
+            start_query_time = time.time()
+            for r in routes:
+                queue_depths(r['uframe_route'])
+            query_time = (time.time() - start_query_time) / len(routes)
+            if queue_depths("Ingest.missing") is not None:
+                self.logger.error("The depth of a missing queue was not None.")
+
+            self.logger.info('')
+            self.logger.info("%-40s %8.2f seconds" % ("Wall clock time", time_elapsed))
+            self.logger.info("%-40s %8.2f seconds" % (
+                "Time to drain at the EDEX rate", float(self.args.files) / self.args.drain))
+            self.logger.info("%-40s %8s" % ("QMF queries", broker.queries))
+            self.logger.info("%-40s %8.2f ms" % ("QMF query time", query_time * 1000))
+            self.logger.info("%-40s %8s messages" % ("High watermark", self.args.high_watermark))
+            self.logger.info("%-40s %8s messages" % ("Peak queue depth", int(max(
+                broker.peaks.values() or [0]))))
+        finally:
+            os.chdir(working_directory)
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    Benchmark(parser.parse_args()).execute()
@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
+import os
+import sys
 from datetime import datetime
+from glob import glob
 
 import logging
 
-from ingestion import Ingestor, log_and_exit
+from ingestion import Ingestor, IngestedFileIndex, log_and_exit
 
 import ingestion.config as config
 import ingestion.logger as logger
@@ -33,6 +36,14 @@ parser_single_file.add_argument('data_source',
 parser_single_file.add_argument('deployment_number',
                                 help="Deployment number.")
 
+# Ingested (ingested)
+parser_ingested = subparsers.add_parser('ingested',
+                                        help="Check the ingested file index for previous ingestions.")
+parser_ingested.add_argument('uframe_route',
+                             help="UFrame route.")
+parser_ingested.add_argument('files', nargs='+',
+                             help="Path to data file or filename mask.")
+
 # Dummy (dummy)
 parser_dummy = subparsers.add_parser('dummy',
                                      help="Create ingestor but don't ingest any data.")
@@ -56,10 +67,22 @@ parser.add_argument('--age', type=int, default=config.MAX_FILE_AGE, metavar="N",
                     help="Only ingest files that are N seconds old or less.")
 parser.add_argument('--age_min', type=int, default=config.MIN_FILE_AGE, metavar="N",
                     help="Only ingest files that are N seconds old or more.")
+parser.add_argument('--prune', action='store_true',
+                    help="Skip directories whose dates or modification times fall outside of --start and --end without listing them.")
 parser.add_argument('--cooldown', type=int, default=config.EDEX['cooldown'], metavar="N",
                     help="Wait N seconds after EDEX services are started before ingesting.")
 parser.add_argument('--quick', type=int, default=config.QUICK_LOOK_QUANTITY, metavar="N",
                     help="Ingest a maximum of N files per CSV.")
+parser.add_argument('--quick_mode', default="first", choices=("first", "oldest", "newest", "spread"),
+                    help="Which files --quick ingests: the first by name, the oldest, the newest, or files spread across the mask's time range.")
+parser.add_argument('--hwm', action='store_true',
+                    help="Only consider files newer than the newest file already sent for each filename mask and route. Can't be used with --quick.")
+parser.add_argument('--hwm_reset', action='store_true',
+                    help="Clear the high water marks of the filename masks being ingested. Implies --hwm.")
+parser.add_argument('--hwm_rewind', default=None, metavar="YYYY-MM-DD",
+                    help="Rewind the high water marks of the filename masks being ingested to the specified date. Implies --hwm.")
+parser.add_argument('--stream', type=int, default=None, metavar="N",
+                    help="Start sending batches while CSVs are still being processed, holding at most N batches in memory.")
 parser.add_argument('--qpid_host', type=str, default=config.QPID['host'], metavar="host",
                     help="The QPID server hostname.")
 parser.add_argument('--qpid_port', type=str, default=config.QPID['port'], metavar="port",
@@ -68,6 +91,24 @@ parser.add_argument('--qpid_user', type=str, default=config.QPID['user'], metava
                     help="The QPID server username.")
 parser.add_argument('--qpid_password', type=str, default=config.QPID['password'], metavar="password",
                     help="The QPID server password.")
+parser.add_argument('--qpid_connections', type=int, default=config.QPID.get('connections', 1), metavar="N",
+                    help="Share at most N connections to the QPID server between all UFrame routes.")
+parser.add_argument('--high_watermark', type=int, default=config.QPID.get('high_watermark'), metavar="N",
+                    help="Pause sending to a UFrame route while its QPID queue holds N or more messages.")
+parser.add_argument('--low_watermark', type=int, default=config.QPID.get('low_watermark'), metavar="N",
+                    help="Resume sending to a paused UFrame route once its QPID queue holds N messages or fewer.")
+parser.add_argument('--qpid_window', type=int, default=config.QPID.get('window'), metavar="N",
+                    help="Send messages to QPID asynchronously, with up to N messages waiting for the server at a time.")
+parser.add_argument('--fan_out', type=int, default=config.QPID.get('fan_out'), metavar="N",
+                    help="Send each file to up to N of its UFrame routes at once.")
+parser.add_argument('--engine', default="single", choices=("single", "process", "thread"),
+                    help="How batches are sent: one at a time, concurrently from MAX_CONCURRENT_JOBS processes, or concurrently from --threads threads in one process.")
+parser.add_argument('--threads', type=int, default=100, metavar="N",
+                    help="The number of batches the thread engine sends at once.")
+parser.add_argument('--chunk', type=int, default=None, metavar="N",
+                    help="Split batches into chunks of at most N files, each sent as a separate job.")
+parser.add_argument('--unordered', action='store_true',
+                    help="Let idle jobs take chunks of a batch that is already being sent, so a route's files may be sent out of order. Ignored with --hwm.")
 
 
 class Task(object):
@@ -96,18 +137,32 @@ class Task(object):
             'min_file_age': self.args.age_min,
             'start_date': parse_date(self.args.start),
             'end_date': parse_date(self.args.end),
+            'prune_directories': self.args.prune,
             'cooldown': self.args.cooldown,
             'quick_look_quantity': self.args.quick,
+            'quick_look_mode': self.args.quick_mode,
+            'high_water_marks': self.args.hwm or self.args.hwm_reset or bool(self.args.hwm_rewind),
+            'high_water_mark_reset': self.args.hwm_reset,
+            'high_water_mark_rewind': parse_date(self.args.hwm_rewind),
             'edex_command': config.EDEX['command'],
             'health_check_enabled': config.EDEX['health_check_enabled'],
             'qpid_host': self.args.qpid_host,
             'qpid_port': self.args.qpid_port,
             'qpid_user': self.args.qpid_user,
             'qpid_password': self.args.qpid_password,
+            'qpid_window': self.args.qpid_window,
+            'qpid_connections': self.args.qpid_connections,
+            'high_watermark': self.args.high_watermark,
+            'low_watermark': self.args.low_watermark,
+            'fan_out': self.args.fan_out,
+            'engine': self.args.engine,
+            'threads': self.args.threads,
+            'chunk_size': self.args.chunk,
+            'ordered': not self.args.unordered,
         }
 
     def execute(self):
-        getattr(self, self.args.task)()
+        return getattr(self, self.args.task)()
 
     def dummy(self):
         """ The dummy task is used for testing basic initialization functions. It creates an
@@ -130,20 +185,56 @@ class Task(object):
         ingestor = Ingestor(**self.options)
 
         # Ingest from each CSV file.
-        for csv_file in csv_files:
-            data_groups = Ingestor.process_csv(csv_file)
+        data_groups = (
+            data_group
+            for csv_file in csv_files
+            for data_group in Ingestor.process_csv(csv_file) or [])
+        succeeded = True
+        if self.args.stream:
+            # Send each batch as soon as it is found.
+            succeeded = ingestor.ingest_from_stream(data_groups, self.args.stream)
+        else:
             for mask, routes, deployment_number in data_groups:
                 ingestor.load_queue(mask, routes, deployment_number)
-        ingestor.ingest_from_queue()
+            ingestor.ingest_from_queue()
+        self.logger.info('')
+        self.logger.info("Listed %s directories (%s pruned) for %s filename masks." % (
+            len(ingestor.listing_cache.listings), len(ingestor.listing_cache.pruned_directories),
+            len(ingestor.listing_cache.masks)))
 
         # Write out any failed ingestions from the entire batch to a new CSV file.
         if ingestor.failed_ingestions:
             ingestor.write_failures_to_csv(timestamp_logname)
 
+        if succeeded is False:
+            self.logger.error("Ingestion did not complete.")
+            return False
+
         self.logger.info('')
         self.logger.info("Ingestion completed.")
         return True
 
+    def ingested(self):
+        """ Look up data files (or every indexed file matching a filename mask) in the ingested file
+            index to see if EDEX has already processed them for the specified UFrame route. """
+        index = IngestedFileIndex()
+        index.update(glob("/".join((config.EDEX['processed_log_path'], "*.p"))))
+
+        for f in self.args.files:
+            f = os.path.abspath(f)
+            if any(c in f for c in "*?["):
+                ingested_files = index.ingested_files(self.args.uframe_route, f)
+                self.logger.info("%s file(s) matching %s have been ingested to %s." % (
+                    len(ingested_files), f, self.args.uframe_route))
+                for ingested_file in ingested_files:
+                    self.logger.info(ingested_file)
+            elif index.contains(self.args.uframe_route, f):
+                self.logger.info("%s has been ingested to %s." % (f, self.args.uframe_route))
+            else:
+                self.logger.info("%s has not been ingested to %s." % (f, self.args.uframe_route))
+        index.close()
+        return True
+
     def from_file(self):
         ingestor = Ingestor(**self.options)
 
@@ -164,6 +255,18 @@ class Task(object):
 
 args = parser.parse_args()
 
+# Quick look ingestion leaves older files unsent, which high water marks raised past them would skip.
+if (args.hwm or args.hwm_reset or args.hwm_rewind) and args.quick:
+    parser.error("--hwm, --hwm_reset and --hwm_rewind can't be used with --quick.")
+
+# Force mode skips the high water mark filter, which is where marks are reset and rewound.
+if (args.hwm_reset or args.hwm_rewind) and args.force:
+    parser.error("--hwm_reset and --hwm_rewind can't be used with --force.")
+
+# The sender pool would be forked from the stream's sender thread while CSVs are still processed.
+if args.stream and args.engine == "process":
+    parser.error("--stream can't be used with --engine process.")
+
 task = Task(args)
 
 if __name__ == '__main__':
@@ -180,10 +283,13 @@ if __name__ == '__main__':
     main_logger.info(
         "Running ingestion task '%s' with the following options: '%s'" % (args.task, args_string))
     main_logger.info('')
+    succeeded = True
     try:
-        task.execute()
+        succeeded = task.execute()
     except Exception:
         main_logger.exception("There was an unexpected error.")
 
     time_elapsed = datetime.now() - task_start_time
     main_logger.info("Task completed in %s." % str(time_elapsed).split('.')[0])
+    if succeeded is False:
+        sys.exit(1)
@@ -1,23 +1,40 @@
-import sys, os, subprocess, multiprocessing
+import sys, os, subprocess, multiprocessing, threading, signal
 import logging, logging.config
 import csv
 import yaml
-import requests
+import psutil
 import time
+import heapq
 
 from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from time import sleep
 from glob import glob
 
 import billiard
-from whelk import shell, pipe
+from whelk import shell
 from qpid import messaging as qm
 
 from config import LOGGING, EDEX
+from index import IngestedFileIndex
+from edex_logs import LogReader, is_compressed, READ_ERRORS
+from processed_logs import ProcessedLog, is_processed_log, write_processed_log, convert_processed_log
+from filesystem import ListingCache
+from high_water_marks import HighWaterMarks
+from jobs_config import JobsConfig
+from rate_limits import RateLimiter
+from backpressure import Backpressure, QmfQueueDepths
+from health import HealthMonitor, HealthCheck
+from scheduler import BatchScheduler
 
 import logger
 
+CHECKPOINT_FILE = "/".join((EDEX['processed_log_path'], "checkpoints.yml"))
+
+SESSION_LOST = "The QPID session was closed before the message was settled."
+
 
 def log_and_exit(error_code):
     exit_logger = logging.getLogger('Exit')
@@ -32,45 +49,253 @@ def set_options(object, attrs, options):
         setattr(object, attr, options.get(attr))
 
 
-class QpidSender:
-    """ A helper class for sending ingest messages to ooi uframe with qpid."""
-    def __init__(self, address, host="localhost", port=5672, user="guest", password="guest"):
+def transient_qpid_error(exception):
+    """ Check if a QPID error was caused by a lost or refused connection, which reconnecting may
+        fix, rather than by the message or its address. """
+    return (
+        isinstance(exception, (
+            qm.exceptions.ConnectionError, qm.exceptions.SessionClosed, qm.exceptions.Detached))
+        and not isinstance(exception, (
+            qm.exceptions.AuthenticationFailure, qm.exceptions.VersionError)))
+
+
+class QpidConnectionPool(object):
+    """ A bounded pool of QPID connections shared round robin by the routes of an Ingestor, with
+        a session per route. A forked process opens connections of its own. """
+
+    def __init__(self, host="localhost", port=5672, user="guest", password="guest", size=1,
+            retries=5, backoff=1, max_backoff=60):
         self.logger = logging.getLogger("QPID")
 
         self.host = str(host)
         self.port = port
         self.user = str(user)
         self.password = str(password)
+        self.size = max(size or 1, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+        self.connections = {}
+        self.sessions = {}
+        self.slots = {}
+
+    def check_process(self):
+        """ Forget connections opened by the parent of a forked process, without closing them, as
+            closing them would close the parent's sessions on the broker. """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.connections = {}
+                self.sessions = {}
+
+    def slot(self, address):
+        with self.lock:
+            return self.slots.setdefault(address, len(self.slots) % self.size)
+
+    def session(self, address):
+        """ Return the session that senders for the address should use, connecting if needed. """
+        with self.lock:
+            self.check_process()
+            if address not in self.sessions:
+                slot = self.slot(address)
+                if slot not in self.connections:
+                    self.connect(slot)
+                self.sessions[address] = self.connections[slot].session()
+            return self.sessions[address]
+
+    def connect(self, slot):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            connection = qm.Connection(
+                host=self.host,
+                port=self.port,
+                username=self.user,
+                password=self.password
+                )
+            try:
+                connection.open()
+                break
+            except qm.exceptions.MessagingError as e:
+                if attempt == self.retries or not transient_qpid_error(e):
+                    raise
+                self.logger.warning(
+                    "Could not connect to QPID (%s), retrying in %s seconds." % (e, delay))
+                sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+        self.connections[slot] = connection
+        self.logger.info("Connection %s open to %s:%s" % (slot, self.host, self.port))
+
+    def reset(self, address):
+        """ Discard the connection used for the address after a transient error. """
+        with self.lock:
+            self.check_process()
+            slot = self.slot(address)
+            connection = self.connections.pop(slot, None)
+            for a in [a for a in self.sessions if self.slots.get(a) == slot]:
+                del self.sessions[a]
+        if connection:
+            self.logger.warning("Connection %s to %s:%s will be reopened." % (
+                slot, self.host, self.port))
+            try:
+                connection.close(timeout=5)
+            except Exception:
+                pass
+
+    def discard(self, address):
+        """ Discard the session used for the address after an error that may have broken it. """
+        with self.lock:
+            self.check_process()
+            session = self.sessions.pop(address, None)
+        if session:
+            self.logger.warning("The session for %s will be reopened." % address)
+            try:
+                session.close(timeout=5)
+            except Exception:
+                pass
+
+    def recover(self, address, exception):
+        """ Discard the connection used for the address after a transient error, or otherwise
+            just the address's session. """
+        if transient_qpid_error(exception):
+            self.reset(address)
+        else:
+            self.discard(address)
+
+    def close(self):
+        with self.lock:
+            self.check_process()
+            for connection in self.connections.itervalues():
+                connection.close()
+            self.connections = {}
+            self.sessions = {}
+
+
+class QpidSender:
+    """ A helper class for sending ingest messages to ooi uframe with qpid, over the connections
+        of a QpidConnectionPool. With a window, up to window messages are sent asynchronously. """
+    def __init__(self, address, host="localhost", port=5672, user="guest", password="guest",
+            window=None, pool=None):
+        self.logger = logging.getLogger("QPID")
+        self.lock = threading.RLock()
+
+        self.pool = pool or QpidConnectionPool(host, port, user, password)
+        self.user = self.pool.user
         self.address = str(address)
+        self.window = window or None
+        self.pending = deque()
+        self.session = None
 
         self.logger.info("Created QpidSender for %s" % self.address)
 
+    def lost(self):
+        """ Check if the pool has closed the session the sender's link is on since it was opened
+            (or, in a forked process, hasn't opened it in this process). """
+        self.pool.check_process()
+        return self.session is not self.pool.sessions.get(self.address)
+
     def connect(self):
-        self.connection = qm.Connection(
-            host=self.host,
-            port=self.port,
-            username=self.user,
-            password=self.password
-            )
-        self.connection.open()
-        self.session = self.connection.session()
-        self.sender = self.session.sender(self.address)
-        self.logger.info("Connection open for %s" % self.address)
-
-    def send(self, message, content_type, sensor, delivery_type, deployment_number):
-        self.sender.send(
-            qm.Message(content=message, content_type=content_type, user_id=self.user, 
-                properties={
-                    "sensor": sensor,
-                    "deliveryType": delivery_type,
-                    "deploymentNumber": deployment_number,
-                    }))
+        """ Open a link to the address on the pool's session for it, unless one is open already.
+            Returns the messages that were still in flight on a lost session as failures, since
+            they can no longer be settled. """
+        if self.session is not None and not self.lost():
+            return []
+        failures = []
+        if self.pending:
+            failures = self.fail(qm.exceptions.SessionClosed(text=SESSION_LOST))
+        self.session = self.pool.session(self.address)
+        if self.window:
+            self.sender = self.session.sender(self.address, capacity=self.window)
+        else:
+            self.sender = self.session.sender(self.address)
+        self.logger.info("Sender open for %s" % self.address)
+        return failures
+
+    def send(self, message, content_type, sensor, delivery_type, deployment_number, context=None):
+        """ Send a message, raising any error. With a window, returns a (context, exception) tuple
+            for each message known to have failed so far instead. """
+        qpid_message = qm.Message(content=message, content_type=content_type, user_id=self.user, 
+            properties={
+                "sensor": sensor,
+                "deliveryType": delivery_type,
+                "deploymentNumber": deployment_number,
+                })
+        with self.lock:
+            failures = self.connect()
+            if self.window:
+                return failures + self.send_async(qpid_message, context)
+            sender = self.sender
+
+        try:
+            sender.send(qpid_message)
+        except qm.exceptions.MessagingError as e:
+            self.pool.recover(self.address, e)
+            raise
+        return failures
+
+    def send_async(self, qpid_message, context):
+        try:
+            self.sender.send(qpid_message, sync=False)
+        except qm.exceptions.MessagingError as e:
+            return self.error(e) + [(context, e)]
+        self.pending.append(context)
+        self.settle()
+        return []
+
+    def settle(self):
+        """ Forget the messages the broker has settled. """
+        while len(self.pending) > self.sender.unsettled():
+            self.pending.popleft()
+
+    def fail(self, exception):
+        """ Return the unsettled messages as failures of the exception. """
+        self.settle()
+        failures = [(context, exception) for context in self.pending]
+        self.pending.clear()
+        return failures
+
+    def error(self, exception):
+        """ Handle an error raised by an asynchronous send or sync, returning the failures. """
+        self.pool.recover(self.address, exception)
+        return self.fail(exception)
+
+    def sync(self):
+        """ Wait for the broker to settle every message in flight. Returns a (context, exception)
+            tuple for each message that failed. """
+        with self.lock:
+            return self.sync_messages()
+
+    def sync_messages(self):
+        if not self.pending:
+            return []
+        if self.lost():
+            return self.fail(qm.exceptions.SessionClosed(text=SESSION_LOST))
+        try:
+            self.session.sync()
+        except qm.exceptions.MessagingError as e:
+            return self.error(e)
+        self.pending.clear()
+        return []
 
     def disconnect(self):
-        self.connection.close()
+        """ Close the sender's link. Its connection is left to the pool. """
+        with self.lock:
+            if self.session is not None and not self.lost():
+                self.sender.close()
+
+def running(process):
+    """ Check if a tracked process is still running, and hasn't exited and been left a zombie. """
+    try:
+        return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
 
 class ServiceManager(object):
     """ A helper class that manages the services that the ingestion depends on."""
+    logger = logging.getLogger('Services')
 
     def __init__(self, test_mode=False, force_mode=False, cooldown=60, health_check_enabled=False, edex_command=EDEX['command'], **kwargs):
 
@@ -81,10 +306,16 @@ class ServiceManager(object):
         set_options(self, ('test_mode', 'edex_command', 'cooldown', 'health_check_enabled', ), options)
 
         self.logger = logging.getLogger('Services')
+        self.process_ids = {}
+        self.tracked_processes = {}
+        self.status_lock = threading.RLock()
+        self.health_check = HealthCheck() if self.health_check_enabled else None
 
         if not options['force_mode']:
-        # Process all logs.
+            # Process all logs and bring the ingested file index up to date.
             self.edex_log_files = self.process_all_logs()
+            self.ingested_index = IngestedFileIndex()
+            self.ingested_index.update(self.edex_log_files)
 
         # Source the EDEX server environment.
         if self.test_mode or EDEX['fake_source']:
@@ -155,7 +386,60 @@ class ServiceManager(object):
         """ Run the edex-server script's status command to get and store process IDs for all
             services, as well as determine the actual PID for the EDEX application.
             Returns True if all services have PIDs, and False if any one service doesn't. """
-        self.process_ids = {}
+        with self.status_lock:
+            return self.refresh_process_ids()
+
+    def refresh_process_ids(self):
+        tracked_processes = self.tracked_processes
+        if self.process_ids and all(self.process_ids.itervalues()) and all(
+                n in tracked_processes and all(running(p) for p in tracked_processes[n])
+                for n in self.process_ids):
+            return True
+
+        services = [n for n in self.process_ids if n not in ('edex_wrapper', 'edex_server')]
+        if services and all(
+                n in tracked_processes and all(running(p) for p in tracked_processes[n])
+                for n in services):
+            # Only the EDEX application's processes have gone, so the services' PIDs still hold.
+            process_ids = dict((n, self.process_ids[n]) for n in services)
+        else:
+            process_ids = self.service_status()
+
+        """ Determine the child processes for edex_ooi to get the actual PID of the EDEX
+            application. """
+        def child_process(parent_name):
+            try:
+                children = psutil.Process(int(process_ids[parent_name])).children()
+            except (psutil.NoSuchProcess, KeyError, TypeError, ValueError):
+                return ""
+            children = [c for c in children if running(c)]
+            return str(min(c.pid for c in children)) if children else ""
+        tracked_processes = {}
+        if self.test_mode:
+            process_ids['edex_wrapper'], process_ids['edex_server'] = "test", "test"
+        else:
+            process_ids['edex_wrapper'] = child_process("edex_ooi")
+            if process_ids['edex_wrapper']:
+                process_ids['edex_server'] = child_process("edex_wrapper")
+            else:
+                process_ids['edex_server'] = None
+
+            # Track the processes of every service that is running. A service whose processes
+            # can't be tracked is treated as not running.
+            for name, pids in process_ids.items():
+                try:
+                    tracked_processes[name] = [
+                        psutil.Process(int(pid))
+                        for pid in ([pids] if isinstance(pids, basestring) else pids)]
+                except (psutil.NoSuchProcess, TypeError, ValueError):
+                    process_ids[name] = None
+        self.process_ids = process_ids
+        self.tracked_processes = tracked_processes
+        return all(self.process_ids.itervalues())
+
+    def service_status(self):
+        """ Run the edex-server script's status command and return the process IDs it reports for
+            each service. """
         try:
             if self.test_mode:
                 status = "edex_ooi: test\npostgres: test\nqpidd: test\npypies: test test \n"
@@ -164,29 +448,26 @@ class ServiceManager(object):
         except Exception as e:
             self.logger.exception("An error occurred when checking the service statuses.")
             log_and_exit(4)
-        else:
-            # Parse and process the output of 'edex-server all status' into a dict.
-            status = [s.strip() for s in status.split('\n') if s.strip()]
-            for s in status:
-                name, value = s.split(":")
-                value = value.strip().split(" ")
-                if len(value) == 1:
-                    value = value[0]
-                self.process_ids[name] = value
-
-            """ Determine the child processes for edex_ooi to get the actual PID of the EDEX
-                application. """
-            def child_process(parent_name):
-                return shell.pgrep("-P", self.process_ids[parent_name])[1].split('\n')[0]
-            if self.test_mode:
-                self.process_ids['edex_wrapper'], self.process_ids['edex_server'] = "test", "test"
-            else:
-                self.process_ids['edex_wrapper'] = child_process("edex_ooi")
-                if self.process_ids['edex_wrapper']:
-                    self.process_ids['edex_server'] = child_process("edex_wrapper")
-                else:
-                    self.process_ids['edex_server'] = None
-        return all(self.process_ids.itervalues())
+
+        # Parse and process the output of 'edex-server all status' into a dict.
+        process_ids = {}
+        status = [s.strip() for s in status.split('\n') if s.strip()]
+        for s in status:
+            name, value = s.split(":")
+            value = value.strip().split(" ")
+            if len(value) == 1:
+                value = value[0]
+            process_ids[name] = value
+        return process_ids
+
+    def healthy(self):
+        """ Check once, without waiting for or restarting anything, whether all services are
+            running and (if enabled) the uFrame health check passes. """
+        if not self.refresh_status():
+            return False
+        if self.health_check_enabled:
+            return self.health_check.check()
+        return True
 
     def wait_until_ready(self, previous_data_file):
         """ Sits in a loop until all services are up and running. """
@@ -208,62 +489,220 @@ class ServiceManager(object):
                 self.restart()
             else:
                 self.logger.warn("Waiting for external processes to restart the services.")
-        while self.health_check_enabled:
-            if requests.get(EDEX['health_check_url']).status_code == 200:
-                break
-            self.logger.warn("uFrame Health Check failed, pausing ingestion.")
-            while True:
-                if requests.get(EDEX['health_check_url']).status_code == 200:
-                    break
+        if self.health_check_enabled:
+            self.health_check.wait()
         return True
 
-    def process_log(self, log_file):
-        """ Processes an EDEX log and creates a new log file with only the relevant,
-            searchable data. """
+    @classmethod
+    def process_log(cls, log_file, checkpoint=None):
+        """ Processes the part of an EDEX log written since its checkpoint (inode and byte offset)
+            into the log's processed log file. Returns the new checkpoint. """
 
         new_log_file = "/".join((EDEX['processed_log_path'], log_file.split("/")[-1] + ".p"))
+        log_file_stat = os.stat(log_file)
+        compressed = is_compressed(log_file)
 
-        # Check to see if the processed log file already exists.
+        offset = 0
         if os.path.isfile(new_log_file):
-            log_file_timestamp = datetime.fromtimestamp(
-                os.path.getmtime(log_file))
-            new_log_file_timestamp = datetime.fromtimestamp(
-                os.path.getmtime(new_log_file))
-            """ Check to see if the original log file has been modified since being previously
-                processed. """
-            if log_file_timestamp < new_log_file_timestamp:
-                self.logger.info(
-                    "%s has already been processed." % log_file)
-                return
+            new_log_file_mtime = os.path.getmtime(new_log_file)
+            if not is_processed_log(new_log_file):
+                # Convert processed log files written before the compact format was introduced.
+                convert_processed_log(new_log_file)
+                cls.logger.info("%s has been converted to the compact format." % new_log_file)
+            if not checkpoint:
+                """ The processed log file predates checkpoints, so it is complete only if the
+                    original log file hasn't been modified since it was processed. """
+                if log_file_stat.st_mtime < new_log_file_mtime:
+                    cls.logger.info("%s has already been processed." % log_file)
+                    return {'inode': log_file_stat.st_ino, 'offset': log_file_stat.st_size}
+            elif checkpoint['inode'] != log_file_stat.st_ino:
+                cls.logger.info(
+                    "%s has been rotated since it was processed and will be re-processed." % log_file)
+            elif log_file_stat.st_size < checkpoint['offset']:
+                cls.logger.info(
+                    "%s has been truncated since it was processed and will be re-processed." % log_file)
+            elif log_file_stat.st_size == checkpoint['offset']:
+                cls.logger.info("%s has already been processed." % log_file)
+                return checkpoint
+            elif compressed:
+                cls.logger.info(
+                    "%s has been modified since it was processed and will be re-processed." % log_file)
             else:
-                self.logger.info(
-                    ("%s has already been processed, but has been modified and will be re-processed."
-                        ) % log_file)
+                offset = checkpoint['offset']
+                cls.logger.info(
+                    "%s has grown since it was processed, processing from byte %s." % (
+                        log_file, offset))
+
+        reader = LogReader(log_file, offset)
+        records = []
+        damaged = False
+        try:
+            for record in reader.records():
+                records.append(record)
+        except READ_ERRORS as e:
+            cls.logger.warning(
+                "%s could not be read to the end (%s), keeping the %s entries read before it." % (
+                    log_file, e, len(records)))
+            damaged = True
+        if records or not offset:
+            if offset:
+                # Merge the new records into the existing processed log file.
+                processed_log = ProcessedLog(new_log_file)
+                records = list(processed_log.records()) + records
+                processed_log.close()
+            entries = write_processed_log(new_log_file, records)
+            cls.logger.info(
+                "%s has been processed and written to %s (%s entries)." % (
+                    log_file, new_log_file, entries))
+        else:
+            cls.logger.info("%s has no new entries since it was processed." % log_file)
+        if damaged:
+            # Leave the checkpoint where it was, so the log is read again next time.
+            return checkpoint
+        return {
+            'inode': log_file_stat.st_ino,
+            'offset': log_file_stat.st_size if compressed else reader.offset,
+            }
 
-        result = shell.zgrep("Finished Processing file", log_file)[1]
-        if not os.path.exists(EDEX['processed_log_path']):
-            os.mkdir(EDEX['processed_log_path'])
-        with open(new_log_file, "w") as outfile:
-            for row in result:
-                outfile.write(row)
-        self.logger.info(
-            "%s has been processed and written to %s." % (log_file, new_log_file))
+    @staticmethod
+    def load_checkpoints():
+        """ Load the checkpoints of all previously processed EDEX logs. """
+        try:
+            with open(CHECKPOINT_FILE) as checkpoint_file:
+                return yaml.safe_load(checkpoint_file) or {}
+        except IOError:
+            return {}
+
+    @staticmethod
+    def save_checkpoints(checkpoints):
+        """ Save the checkpoints of all processed EDEX logs, replacing the checkpoint file
+            atomically so an interrupted run can't leave it partially written. """
+        temporary_file = CHECKPOINT_FILE + ".tmp"
+        with open(temporary_file, "w") as checkpoint_file:
+            yaml.safe_dump(checkpoints, checkpoint_file, default_flow_style=False)
+        os.rename(temporary_file, CHECKPOINT_FILE)
 
     def process_all_logs(self):
-        """ Processes all EDEX logs in preparation for duplicate ingestion prevention. """
+        """ Processes all EDEX logs in preparation for duplicate ingestion prevention. When more
+            than one log scan process is configured, the logs are processed in parallel by a
+            pool of processes and their checkpoints are merged once all of them are done. """
+        scan_start_time = time.time()
 
-        # Build a list of all valid EDEX logs
+        # Build a list of all valid EDEX logs from every log path.
+        edex_logs = []
         for log_path in EDEX['log_paths']:
-            edex_logs  = glob("/".join((log_path, "edex-ooi*.log")))
+            edex_logs += glob("/".join((log_path, "edex-ooi*.log")))
             edex_logs += glob("/".join((log_path, "edex-ooi*.log.[0-9]*")))
             edex_logs += glob("/".join((log_path, "*.zip")))
-            edex_logs = sorted([l for l in edex_logs if ".lck" not in l])
+        edex_logs = [l for l in edex_logs if ".lck" not in l]
+
+        """ Logs are processed into files named after the log, so if the same log name shows up in
+            more than one log path, only the most recently modified copy is processed. """
+        latest_logs = {}
+        for log_file in sorted(edex_logs, key=os.path.getmtime):
+            log_name = log_file.split("/")[-1]
+            if log_name in latest_logs:
+                self.logger.warning("%s is also in %s, only the latest copy will be processed." % (
+                    latest_logs[log_name], log_file))
+            latest_logs[log_name] = log_file
+        edex_logs = sorted(latest_logs.values())
 
         self.logger.info("Pre-processing log files for duplicate searching.")
-        for log_file in edex_logs:
-            self.process_log(log_file)
+        if not os.path.exists(EDEX['processed_log_path']):
+            os.mkdir(EDEX['processed_log_path'])
+        checkpoints = self.load_checkpoints()
+        jobs = [(log_file, checkpoints.get(log_file)) for log_file in edex_logs]
+        processes = min(EDEX.get('log_scan_processes') or 1, len(jobs))
+        if processes > 1:
+            self.logger.info("Using %s processes to pre-process %s log files." % (
+                processes, len(jobs)))
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = list(pool.imap_unordered(timed_process_log, jobs))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [timed_process_log(job) for job in jobs]
+
+        for log_file, checkpoint, time_elapsed in sorted(results):
+            checkpoints[log_file] = checkpoint
+            self.logger.info("%s pre-processed in %.2f seconds." % (log_file, time_elapsed))
+        self.save_checkpoints(checkpoints)
+        self.logger.info("Pre-processed %s log files in %.2f seconds." % (
+            len(results), time.time() - scan_start_time))
         return glob("/".join((EDEX['processed_log_path'], "*.p")))
 
+
+def timed_process_log(job):
+    """ Process a single EDEX log, returning the log's name, its new checkpoint and how long
+        processing took. Defined outside of ServiceManager so the log scan pool can use it. """
+    log_file, checkpoint = job
+    start_time = time.time()
+    checkpoint = ServiceManager.process_log(log_file, checkpoint)
+    return log_file, checkpoint, time.time() - start_time
+
+
+# The Ingestor a sender pool worker sends batches with, set when the worker starts.
+worker_ingestor = None
+
+
+def init_sender_worker(ingestor):
+    """ Keep the sender pool worker's copy of the Ingestor, so its QPID connections and other
+        state are reused for every batch the worker sends. """
+    global worker_ingestor
+    worker_ingestor = ingestor
+
+
+def send_batch(batch):
+    """ Send a batch in a sender pool worker, returning its failed ingestions and routes, stats
+        and health metrics. A SIGTERM stops ingestion after the file being sent (billiard resets
+        the handlers set by init_sender_worker, so it is set here). """
+    ingestor = worker_ingestor
+    signal.signal(signal.SIGTERM, lambda signum, frame: ingestor.stop())
+    ingestor.failed_ingestions = []
+    start_time = time.time()
+    sent, failed_routes = ingestor.send(
+        batch['files'], batch['deployment_number'], batch['mask'], batch.get('held_routes', ()))
+    return {
+        'mask': batch['mask'],
+        'failed_ingestions': ingestor.failed_ingestions,
+        'failed_routes': sorted(failed_routes),
+        'files': sent,
+        'time': time.time() - start_time,
+        'pid': os.getpid(),
+        'health': ingestor.health_monitor.take_metrics(),
+        }
+
+
+def heap_order(heap):
+    """ Yield the filenames of a list of (key, filename) tuples in key order, heapifying the list
+        and popping from it so only as much of it is sorted as is consumed. """
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[1]
+
+
+def spread_order(files, count):
+    """ Yield the filenames of a list of (mtime, filename) tuples so that the first count of them
+        are spread evenly across the files' time range. """
+    first, last = min(files)[0], max(files)[0]
+    width = float(last - first) / count or 1
+    intervals = {}
+    for mtime, filename in files:
+        i = min(int((mtime - first) / width), count - 1)
+        intervals.setdefault(i, []).append((abs(mtime - first - (i + 0.5) * width), filename))
+    intervals = [heap_order(intervals[i]) for i in sorted(intervals)]
+    while intervals:
+        remaining = []
+        for interval in intervals:
+            filename = next(interval, None)
+            if filename is not None:
+                yield filename
+                remaining.append(interval)
+        intervals = remaining
+
+
 class Ingestor(object):
     """ A helper class designed to handle the ingestion process."""
     logger = logging.getLogger('Ingestor')
@@ -271,8 +710,11 @@ class Ingestor(object):
     def __init__(self,
             test_mode=False, force_mode=False, sleep=0,
             start_date=None, end_date=None, max_file_age=None, min_file_age=None,
-            quick_look_quantity=None, no_edex=False,
-            qpid_host=None, qpid_port=None, qpid_user=None, qpid_password=None,
+            quick_look_quantity=None, quick_look_mode="first", no_edex=False, prune_directories=False,
+            high_water_marks=False, high_water_mark_reset=False, high_water_mark_rewind=None,
+            qpid_host=None, qpid_port=None, qpid_user=None, qpid_password=None, qpid_window=None,
+            qpid_connections=1, high_watermark=None, low_watermark=None, fan_out=None,
+            engine="single", threads=100, chunk_size=None, ordered=True, queue_depths=None,
             service_manager=None, **kwargs):
 
         self.logger = logging.getLogger('Ingestor')
@@ -285,13 +727,53 @@ class Ingestor(object):
         set_options(self, (
                 'test_mode', 'force_mode', 'sleep',
                 'start_date', 'end_date', 'max_file_age', 'min_file_age',
-                'quick_look_quantity', 'no_edex',
-                'qpid_host', 'qpid_port', 'qpid_user', 'qpid_password',
+                'quick_look_quantity', 'quick_look_mode', 'no_edex', 'prune_directories',
+                'high_water_marks', 'high_water_mark_reset', 'high_water_mark_rewind',
+                'qpid_host', 'qpid_port', 'qpid_user', 'qpid_password', 'qpid_window',
+                'qpid_connections', 'high_watermark', 'low_watermark', 'fan_out',
+                'engine', 'threads', 'chunk_size', 'ordered',
                 ),
             options)
-        self.queue = deque()
+        # Shared with the sender pool's workers, so a stop reaches the batches they are sending.
+        self.stopping = multiprocessing.Event()
+        # High water marks are only safe to raise if each batch's files are sent in order.
+        if not self.ordered and self.high_water_marks:
+            self.logger.warning("Ignoring --unordered, files are sent in order with --hwm.")
+        self.queue = BatchScheduler(
+            stopping=self.stopping, chunk_size=self.chunk_size,
+            ordered=self.ordered or bool(self.high_water_marks))
         self.failed_ingestions = []
         self.qpid_senders = {}
+        self.qpid_senders_lock = threading.Lock()
+        self.rate_limiter = RateLimiter()
+        self.jobs_config = JobsConfig()
+
+        """ If a high watermark is set, pause sending to any route whose queue holds that many
+            messages. Queue depths are read from the broker's management agent unless another
+            source of queue depths is given. """
+        self.backpressure = None
+        if self.high_watermark:
+            self.backpressure = Backpressure(
+                queue_depths or QmfQueueDepths(
+                    host=self.qpid_host, port=self.qpid_port,
+                    user=self.qpid_user, password=self.qpid_password),
+                self.high_watermark, self.low_watermark)
+        self.qpid_pool = QpidConnectionPool(
+            host=self.qpid_host, port=self.qpid_port,
+            user=self.qpid_user, password=self.qpid_password, size=self.qpid_connections)
+
+        """ Directory listings are shared by every filename mask loaded by this Ingestor. If
+            directory pruning is enabled, directories that can't hold files modified between the
+            start and end dates aren't listed at all. """
+        if self.prune_directories:
+            self.listing_cache = ListingCache(
+                time.mktime(self.start_date.timetuple()) if self.start_date else None,
+                time.mktime(self.end_date.timetuple()) if self.end_date else None)
+        else:
+            self.listing_cache = ListingCache()
+
+        # Keep track of the newest file sent for each filename mask and route if requested.
+        self.high_water_marks = HighWaterMarks() if self.high_water_marks else None
 
         """ Instantiate a ServiceManager for this Ingestor and start the services if any are not
             running. """
@@ -299,36 +781,32 @@ class Ingestor(object):
         if not self.service_manager.refresh_status():
             self.service_manager.action("start")
 
-    @staticmethod
-    def update_max_jobs(max_jobs, previous_timestamp):
-        try:
-            jobs_config_file = "jobs.yml"
-            if os.path.isfile(jobs_config_file):
-                last_updated = datetime.fromtimestamp(os.path.getmtime(jobs_config_file))
-                if last_updated == previous_timestamp:
-                    return max_jobs, last_updated
-                else:
-                    return yaml.load(open(jobs_config_file))['MAX_CONCURRENT_JOBS'], last_updated
-        except:
-            pass
-        return 1, previous_timestamp
+        # Check the health of the services in the background while ingesting.
+        self.health_monitor = HealthMonitor(self.service_manager)
+
+    def max_jobs(self):
+        """ Return MAX_CONCURRENT_JOBS from the jobs config file (1 if it isn't set). """
+        self.jobs_config.reload()
+        return self.jobs_config.get('MAX_CONCURRENT_JOBS', 1)
 
     def get_qpid_sender(self, route):
         """ Connect or retrieve an already connected QPID sender for a specific route."""
         qpid_sender = self.qpid_senders.get(route, None)
         if not qpid_sender:
-            qpid_sender = QpidSender(
-                address=route, 
-                host=self.qpid_host, port=self.qpid_port, 
-                user=self.qpid_user, password=self.qpid_password)
-            qpid_sender.connect()
-            self.qpid_senders[route] = qpid_sender
+            with self.qpid_senders_lock:
+                qpid_sender = self.qpid_senders.get(route, None)
+                if not qpid_sender:
+                    qpid_sender = QpidSender(
+                        address=route, window=self.qpid_window, pool=self.qpid_pool)
+                    qpid_sender.connect()
+                    self.qpid_senders[route] = qpid_sender
         return qpid_sender
 
     def close_qpid_connections(self):
-        """ Close all connected QPID senders. """
+        """ Close all connected QPID senders and their connections. """
         for route in self.qpid_senders:
             self.qpid_senders[route].disconnect()
+        self.qpid_pool.close()
 
     @classmethod
     def process_csv(cls, csv_file):
@@ -381,25 +859,133 @@ class Ingestor(object):
 
         return [(mask, routes[mask], deployment_number) for mask in routes]
 
-    def in_edex_log(self, mask, data_file, uframe_route):
-        """ Check EDEX logs to see if the file has been ingested by EDEX."""
-        return bool(pipe(
-                pipe.grep(
-                    "%s.*%s" % (uframe_route, mask.replace("*", ".*")), 
-                    *self.service_manager.edex_log_files
-                    ) | 
-                pipe.grep(
-                    "-m1", "%s.*%s" % (uframe_route, data_file)
-                    ) | 
-                pipe.head("-1")
-            )[1])
+    def quick_look_order(self, data_files):
+        """ Return the sorted data_files in the order quick look ingestion should consider them,
+            depending on the quick look mode. """
+        if not self.quick_look_quantity or self.quick_look_mode in (None, "first") or not data_files:
+            return data_files
+        files = [(self.listing_cache.mtime(f), f) for f in data_files]
+        if self.quick_look_mode == "oldest":
+            return heap_order(files)
+        if self.quick_look_mode == "newest":
+            return heap_order([(-mtime, f) for mtime, f in files])
+        return spread_order(files, self.quick_look_quantity)
+
+    def filter_ingested(self, mask, data_files, routes):
+        """ Return (data_file, routes) pairs for the files in the sorted data_files list that
+            haven't been ingested to each route, stopping once the quick look quantity is met. """
+        self.logger.info(
+            "Determining if any files matching %s have already been ingested." % mask)
+        index = self.service_manager.ingested_index
+        ingested_files = {}
+        if index.filters is None:
+            for p in routes:
+                ingested_files[p['uframe_route']] = set(
+                    index.ingested_files(p['uframe_route'], mask))
+
+        def ingested(data_file, uframe_route):
+            if index.filters is None:
+                return data_file in ingested_files[uframe_route]
+            return index.contains(uframe_route, data_file)
+
+        filtered_data_files = []
+        for data_file in self.quick_look_order(data_files):
+            valid_routes = []
+            for p in routes:
+                if ingested(data_file, p['uframe_route']):
+                    self.logger.warning((
+                        "EDEX logs indicate that %s (%s) has already been ingested. "
+                        "The file will not be reingested.") % (data_file, p['uframe_route']))
+                    continue
+                valid_routes.append(p)
+            if valid_routes:
+                filtered_data_files.append((data_file, valid_routes))
+
+            """ If a quick look quantity is set (either through the config.yml or the
+                command-line argument), exit the loop once the quick look quantity is met. """
+            if self.quick_look_quantity and self.quick_look_quantity == len(filtered_data_files):
+                self.logger.info(
+                    "%s of %s file(s) from %s set for quick look ingestion." % (
+                        len(filtered_data_files), len(data_files), mask))
+                break
+        else:
+            self.logger.info(
+                "%s file(s) from %s set for ingestion." % (len(filtered_data_files), mask))
+        return filtered_data_files
+
+    def filter_high_water_marks(self, mask, data_files, routes):
+        """ Remove the (data_file, mtime) tuples no newer than the high water marks of every route
+            of the mask, after resetting or rewinding the marks if requested. """
+        rewind = None
+        if self.high_water_mark_rewind:
+            rewind = time.mktime(self.high_water_mark_rewind.timetuple())
+
+        marks = []
+        for p in routes:
+            mark = self.high_water_marks.get(mask, p['uframe_route'])
+            if mark and (self.high_water_mark_reset or rewind is not None):
+                if self.high_water_mark_reset:
+                    mark = None
+                elif mark[0] >= rewind:
+                    mark = (rewind, "")
+                if not self.test_mode:
+                    self.high_water_marks.rewind(
+                        mask, p['uframe_route'], None if self.high_water_mark_reset else rewind)
+            marks.append(mark)
+        if not marks or None in marks:
+            return data_files
+
+        high_water_mark = min(marks)
+        filtered_data_files = [(f, m) for f, m in data_files if (m, f) > high_water_mark]
+        self.logger.info("%s file(s) rejected by the high water mark (%s) filter." % (
+            len(data_files) - len(filtered_data_files), high_water_mark[1] or
+            datetime.fromtimestamp(high_water_mark[0])))
+        return filtered_data_files
+
+    def filter_files(self, data_files):
+        """ Apply the date and file age filters to a list of (data_file, mtime) tuples in a single
+            pass. Returns the names of the files that pass every filter. """
+        now = time.time()
+        filters = []
+        # If a start date is set, only ingest files modified after that start date.
+        if self.start_date:
+            start = time.mktime(self.start_date.timetuple())
+            filters.append(("start date (%s)" % self.start_date, lambda mtime: mtime > start))
+        # If a end date is set, only ingest files modified before that end date.
+        if self.end_date:
+            end = time.mktime(self.end_date.timetuple())
+            filters.append(("end date (%s)" % self.end_date, lambda mtime: mtime < end))
+        # Only ingest files younger than max file age
+        if self.max_file_age:
+            filters.append((
+                "maximum file age (%s seconds)" % self.max_file_age,
+                lambda mtime: now - mtime < self.max_file_age))
+        # Only ingest files older than min file age
+        if self.min_file_age:
+            filters.append((
+                "minimum file age (%s seconds)" % self.min_file_age,
+                lambda mtime: now - mtime > self.min_file_age))
+
+        rejected = [0] * len(filters)
+        filtered_data_files = []
+        for data_file, mtime in data_files:
+            for i, (name, accept) in enumerate(filters):
+                if not accept(mtime):
+                    rejected[i] += 1
+                    break
+            else:
+                filtered_data_files.append(data_file)
+
+        for (name, accept), count in zip(filters, rejected):
+            self.logger.info("%s file(s) rejected by the %s filter." % (count, name))
+        return filtered_data_files
 
     def load_queue(self, mask, routes, deployment_number):
         """ Finds the files that match the filename_mask parameter and loads them into the
             Ingestor object's queue. """
 
-        # Get a list of files that match the file mask and log the list size.
-        data_files = sorted(glob(mask))
+        # Get a list of files (with their modification times) that match the file mask.
+        data_files = self.listing_cache.scan(mask)
 
         if not deployment_number:
             # Grab the deployment number from the file name mask if no deployment number is specified.
@@ -422,46 +1008,18 @@ class Ingestor(object):
             "%s file(s) found for %s before filtering." % (
                 len(data_files), mask))
 
-        # If a start date is set, only ingest files modified after that start date.
-        if self.start_date:
-            self.logger.info("Start date set to %s, filtering file list." % (
-                self.start_date))
-            data_files = [
-                f for f in data_files
-                if datetime.fromtimestamp(os.path.getmtime(f)) > self.start_date]
-
-        # If a end date is set, only ingest files modified before that end date.
-        if self.end_date:
-            self.logger.info("End date set to %s, filtering file list." % (
-                self.end_date))
-            data_files = [
-                f for f in data_files
-                if datetime.fromtimestamp(os.path.getmtime(f)) < self.end_date]
+        # Skip files older than the newest file already sent, unless force mode is active.
+        if self.high_water_marks and not self.force_mode:
+            data_files = self.filter_high_water_marks(mask, data_files, routes)
 
-        # Only ingest files younger than max file age
-        if self.max_file_age:
-            self.logger.info(
-                "Maximum file age set to %s seconds, filtering file list.", self.max_file_age)
-            now = time.time()
-            data_files = [
-                f for f in data_files
-                if now - os.path.getmtime(f) < self.max_file_age]
-
-        # Only ingest files older than min file age
-        if self.min_file_age:
-            self.logger.info(
-                "Minimum file age set to %s seconds, filtering file list.", self.min_file_age)
-            now = time.time()
-            data_files = [
-                f for f in data_files
-                if now - os.path.getmtime(f) > self.min_file_age]
+        data_files = self.filter_files(data_files)
 
         """ Check if the data_file has previously been ingested. If it has, then skip it, unless
             force mode (-f) is active. """
         filtered_data_files = []
         if self.force_mode:
             # If force mode is active, add all data files to the queue with the respective routes.
-            for data_file in data_files:
+            for data_file in self.quick_look_order(data_files):
                 if self.quick_look_quantity and self.quick_look_quantity == len(filtered_data_files):
                     self.logger.info(
                         "%s of %s file(s) from %s set for quick look ingestion." % (
@@ -469,43 +1027,11 @@ class Ingestor(object):
                     break
                 filtered_data_files.append((data_file, routes))
         else:
-            # Otherwise, check EDEX logs to see if any file matching the mask has been ingested.
-            route_in_logs = {}
-            for p in routes:
-                route_in_logs[p['uframe_route']] = bool(pipe(
-                        pipe.grep(
-                            "%s.*%s" % (p['uframe_route'], mask.replace("*", ".*")), 
-                            *self.service_manager.edex_log_files
-                            ) |
-                        pipe.head("-1")
-                        )[1])
+            # Otherwise, filter out the files the index shows have already been ingested.
+            filtered_data_files = self.filter_ingested(mask, data_files, routes)
 
-            self.logger.info(
-                "Determining if any files matching %s have already been ingested." % mask)
-            for data_file in data_files:
-                valid_routes = []
-                for p in routes:
-                    uframe_route = p['uframe_route']
-                    if route_in_logs[uframe_route]:
-                        if self.in_edex_log(mask, data_file, uframe_route):
-                            self.logger.warning((
-                                "EDEX logs indicate that %s (%s) has already been ingested. "
-                                "The file will not be reingested.") % (data_file, uframe_route))
-                            continue
-                    valid_routes.append(p)
-                if len(valid_routes) > 0:
-                    filtered_data_files.append((data_file, valid_routes))
-
-                """ If a quick look quantity is set (either through the config.yml or the
-                    command-line argument), exit the loop once the quick look quantity is met. """
-                if self.quick_look_quantity and self.quick_look_quantity == len(filtered_data_files):
-                    self.logger.info(
-                        "%s of %s file(s) from %s set for quick look ingestion." % (
-                            len(filtered_data_files), len(data_files), mask))
-                    break
-            else:
-                self.logger.info(
-                    "%s file(s) from %s set for ingestion." % (len(filtered_data_files), mask))
+        # Files picked out of order for quick look ingestion are still sent in order.
+        filtered_data_files.sort()
 
         # If no files are found, consider the entire filename mask a failure and track it.
         if len(filtered_data_files) == 0:
@@ -516,52 +1042,251 @@ class Ingestor(object):
         self.queue.append({
             "mask": mask,
             "files": filtered_data_files,
-            'deployment_number': deployment_number
+            'deployment_number': deployment_number,
+            'newest': max(self.listing_cache.mtime(f) for f, r in filtered_data_files),
             })
 
-    def ingest_from_queue(self, use_billiard=False):
-        """ Call the ingestion command for each batch of files in the Ingestor object's queue,
-            using multiple processes to concurrently send batches. """
-        max_jobs, max_jobs_last_updated = self.update_max_jobs(1, datetime.now())
+    def stop(self):
+        """ Stop ingesting once the files being sent have been sent. """
+        self.stopping.set()
 
-        self.logger.info('')
-        pool = []
-        if use_billiard:
-            self.logger.info("Using multiprocessing to ingest.")
-            while self.queue:
-                batch = self.queue.popleft()
-                # Wait for any job slots to become available
-                while len(pool) == max_jobs:
-                    max_jobs, max_jobs_last_updated = self.update_max_jobs(
-                        max_jobs, max_jobs_last_updated)
-                    pool = [j for j in pool if j.is_alive()]
-
-                # Create, track, and start the job.
-                job = billiard.process.Process(
-                    target=self.send, args=(batch['files'], batch['deployment_number']))
-                pool.append(job)
-                job.start()
-                self.logger.info(
-                    "Ingesting %s files for %s from the queue in PID %s." % (
-                        len(batch['files']), batch['mask'], job.pid))
+    def fail_files(self, files):
+        """ Track (data_file, routes) pairs that were left unsent as failed ingestions, so they are
+            written out to be ingested later. """
+        for data_file, routes in files:
+            for r in routes:
+                self.failed_ingestions.append(dict(filename_mask=data_file, **r))
+
+    @contextmanager
+    def stop_on_sigterm(self):
+        """ Stop ingesting cleanly on a SIGTERM while in the context, rather than being killed
+            part way through a batch. Signal handlers can only be set from the main thread, so
+            elsewhere it is left to the caller to call stop. """
+        if not isinstance(threading.current_thread(), threading._MainThread):
+            yield
+            return
 
-            # Wait for all jobs to end completely.
-            while any([job for job in pool if job.is_alive()]):
-                pass
+        def handler(signum, frame):
+            self.logger.warning("Got a SIGTERM, stopping after the files being sent.")
+            self.stop()
+        previous_handler = signal.signal(signal.SIGTERM, handler)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    def ingest_from_queue(self, use_billiard=False, batches=None):
+        """ Call the ingestion command for each batch of files in the Ingestor object's queue (or
+            yielded by batches), with the single, process (or use_billiard) or thread engine. """
+        engine = "process" if use_billiard else self.engine or "single"
+
+        if batches is None:
+            batches = iter(self.queue.get, None)
+
+        self.logger.info('')
+        start_time = time.time()
+        with self.stop_on_sigterm():
+            if engine == "process":
+                self.logger.info("Using multiprocessing to ingest.")
+                stats = self.ingest_with_pool(batches)
+            elif engine == "thread":
+                self.logger.info("Using %s threads to ingest." % self.threads)
+                stats = self.ingest_with_threads(batches, self.threads)
+            else:
+                self.logger.info("Using single process to ingest.")
+                stats = {'batches': 0, 'files': 0}
+                for batch in batches:
+                    self.logger.info(
+                        "Ingesting %s files for %s from the queue." % (len(batch['files']), batch['mask'])
+                        )
+                    try:
+                        sent, failed_routes = self.send(
+                            batch['files'], batch['deployment_number'], batch['mask'],
+                            batch.get('held_routes', ()))
+                    except Exception:
+                        self.fail_files(batch['files'])
+                        self.queue.done(batch, failed=True)
+                        raise
+                    self.queue.done(batch, failed_routes)
+                    stats['batches'] += 1
+                    stats['files'] += sent
+                    if self.stopping.is_set():
+                        break
+
+        if self.stopping.is_set():
+            # Track the batches that were never sent, along with the files left unsent.
+            unsent = self.queue.drain()
+            for batch in unsent:
+                self.fail_files(batch['files'])
+            self.logger.warning(
+                "Ingestion stopped before all batches were sent (%s batch(es) left unsent)." % (
+                    len(unsent)))
         else:
-            self.logger.info("Using single process to ingest.")
-            while self.queue:
-                batch = self.queue.popleft()
+            self.logger.info("All batches completed.")
+        self.logger.info(
+            "Sent %s batches (%s files) in %.2f seconds with %s failed ingestions." % (
+                stats['batches'], stats['files'], time.time() - start_time,
+                len(self.failed_ingestions)))
+        if not self.no_edex:
+            self.health_monitor.stop()
+            self.health_monitor.log_metrics()
+
+    def ingest_with_pool(self, batches):
+        """ Send the batches from a pool of worker processes, returning the number of batches and
+            files sent. Submitting a batch blocks while max_jobs batches are being sent. """
+        stats = {'batches': 0, 'files': 0}
+        done = threading.Condition()
+        sending = [0]
+
+        def batch_sent(batch, result):
+            """ Collect a batch's results (in the pool's result handler thread). """
+            self.queue.done(batch, result['failed_routes'])
+            with done:
+                self.failed_ingestions.extend(result['failed_ingestions'])
+                self.health_monitor.add_metrics(result['health'])
+                stats['batches'] += 1
+                stats['files'] += result['files']
+                sending[0] -= 1
+                done.notify()
+            self.logger.info(
+                "Sent %s files for %s in PID %s in %.2f seconds (%s failed ingestions)." % (
+                    result['files'], result['mask'], result['pid'], result['time'],
+                    len(result['failed_ingestions'])))
+
+        def batch_failed(batch, exception):
+            self.queue.done(batch, failed=True)
+            with done:
+                self.fail_files(batch['files'])
+                sending[0] -= 1
+                done.notify()
+            self.logger.error("A sender pool worker failed to send a batch: %r" % exception)
+
+        max_jobs = self.max_jobs()
+        pool = billiard.Pool(max_jobs, initializer=init_sender_worker, initargs=(self, ))
+        pool_size = max_jobs
+        try:
+            for batch in batches:
+                # Wait for a job slot to become available.
+                with done:
+                    while sending[0] >= max_jobs and not self.stopping.is_set():
+                        done.wait(1)
+                        max_jobs = self.max_jobs()
+                    if self.stopping.is_set():
+                        self.fail_files(batch['files'])
+                        self.queue.done(batch, failed=True)
+                        break
+                    sending[0] += 1
+                if max_jobs > pool_size:
+                    pool.grow(max_jobs - pool_size)
+                    pool_size = max_jobs
+
+                pool.apply_async(
+                    send_batch, (batch, ),
+                    callback=lambda result, batch=batch: batch_sent(batch, result),
+                    error_callback=lambda exception, batch=batch: batch_failed(batch, exception))
+                self.logger.info(
+                    "Ingesting %s files for %s from the queue." % (
+                        len(batch['files']), batch['mask']))
+        finally:
+            # Let the workers finish the batches they were given, then shut them down. Wait with a
+            # timeout, so the main thread can still handle a SIGTERM.
+            with done:
+                while sending[0]:
+                    done.wait(1)
+            pool.close()
+            pool.join()
+        return stats
+
+    def ingest_with_threads(self, batches, threads):
+        """ Send the batches from threads in this process, returning the number of batches and
+            files sent. Each thread takes the next batch as soon as it has sent its last one. """
+        stats = {'batches': 0, 'files': 0}
+        lock = threading.Lock()
+        batches = iter(batches)
+
+        def sender():
+            while not self.stopping.is_set():
+                with lock:
+                    batch = next(batches, None)
+                if batch is None:
+                    return
                 self.logger.info(
-                    "Ingesting %s files for %s from the queue." % (len(batch['files']), batch['mask'])
-                    )
-                self.send(batch['files'], batch['deployment_number'])
+                    "Ingesting %s files for %s from the queue." % (
+                        len(batch['files']), batch['mask']))
+                try:
+                    sent, failed_routes = self.send(
+                        batch['files'], batch['deployment_number'], batch['mask'],
+                        batch.get('held_routes', ()))
+                except Exception:
+                    self.logger.exception("An error occurred when ingesting %s." % batch['mask'])
+                    self.fail_files(batch['files'])
+                    self.queue.done(batch, failed=True)
+                    continue
+                self.queue.done(batch, failed_routes)
+                with lock:
+                    stats['batches'] += 1
+                    stats['files'] += sent
+
+        workers = [
+            threading.Thread(target=sender, name="Sender-%s" % i)
+            for i in range(max(threads or 1, 1))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        # Join with a timeout, so the main thread can still handle a SIGTERM.
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1)
+        return stats
+
+    def ingest_from_stream(self, data_groups, queue_size, use_billiard=False):
+        """ Load the queue from an iterable of (mask, routes, deployment_number) tuples while a
+            sender thread ingests the batches already found, holding at most queue_size batches.
+            Not for the process engine, whose workers would be forked while discovery runs. """
+        completed = []
+
+        def send_batches():
+            try:
+                self.ingest_from_queue(use_billiard)
+                completed.append(True)
+            except Exception:
+                self.logger.exception("An error occurred when ingesting from the stream.")
+
+        self.queue.open()
+        sender = threading.Thread(target=send_batches)
+        sender.daemon = True
+        sender.start()
 
-        self.logger.info("All batches completed.")
+        with self.stop_on_sigterm():
+            try:
+                for mask, routes, deployment_number in data_groups:
+                    if self.stopping.is_set() or not sender.is_alive():
+                        break
+                    self.load_queue(mask, routes, deployment_number)
+                    # Wait for room in the queue, giving up if the sender thread has stopped.
+                    while not self.queue.wait_for_room(queue_size, 1):
+                        if not sender.is_alive():
+                            break
+            finally:
+                self.queue.close()
+                while sender.is_alive():
+                    sender.join(1)
+
+        if not completed:
+            # Track the batches the sender left behind, so they are written out with the failures.
+            unsent = self.queue.drain()
+            for batch in unsent:
+                self.fail_files(batch['files'])
+            self.logger.error(
+                "The sender stopped before all batches were sent (%s batch(es) left unsent)." % (
+                    len(unsent)))
+            return False
+        return not self.stopping.is_set()
 
-    def send(self, files, deployment_number):
+    def send(self, files, deployment_number, mask=None, held_routes=()):
         """ Calls UFrame's ingest sender application with the appropriate command-line arguments
-            for all files specified in the files list. """
+            for all files specified in the files list, leaving the high water marks of
+            held_routes. Returns the number of files sent and the routes that failed. """
 
         # Define some helper methods.
         def annotate_parameters(filename, route, designator, source):
@@ -573,33 +1298,100 @@ class Ingestor(object):
                 'data_source': source,
                 }
 
+        def deliver(failures):
+            """ Hand the failures of asynchronous sends to the send calls they belong to, which
+                may be running in other threads sharing the senders. """
+            for context, e in failures:
+                context[0].append((context[1:], e))
+
+        def record_failures():
+            """ Log and track the messages of this call QPID failed to send asynchronously. """
+            while async_failures:
+                (filename, route, designator, source), e = async_failures.pop(0)
+                self.logger.error(
+                    "There was a problem with qpid when ingesting %s (Exception %s)." % (
+                        filename, e))
+                self.failed_ingestions.append(
+                    annotate_parameters(filename, route, designator, source))
+                failed_routes.add(route)
+
+        def wait_to_send(uframe_route):
+            """ Wait for the route's queue to drain if EDEX has fallen behind, and until the global
+                and route rate limits allow another message. """
+            if self.backpressure and not self.test_mode:
+                self.backpressure.wait(uframe_route)
+            self.rate_limiter.wait(uframe_route)
+
+        def send_to_route(message):
+            """ Attempt to send the data file over QPID to one of its routes. Returns the error
+                of the send, if any. """
+            data_file, r = message
+            if self.test_mode:
+                return None
+            context = (
+                async_failures, data_file, r['uframe_route'], r['reference_designator'],
+                r['data_source'])
+            try:
+                qpid_sender = self.get_qpid_sender(r['uframe_route'])
+                if qpid_sender.window:
+                    # Deliver the failures before another call can sync the sender.
+                    with qpid_sender.lock:
+                        deliver(qpid_sender.send(
+                            data_file, "text/plain", r['reference_designator'], r['data_source'],
+                            deployment_number, context=context))
+                else:
+                    deliver(qpid_sender.send(
+                        data_file, "text/plain", r['reference_designator'], r['data_source'],
+                        deployment_number, context=context))
+            except qm.exceptions.MessagingError as e:
+                return e
+            return None
+
         sender_process = multiprocessing.current_process()
 
         deployment_number = str(deployment_number)
 
+        # Track the newest file successfully sent to each route.
+        newest_files = {}
+        failed_routes = set()
+        async_failures = []
+
+        # Send a file to several routes at once from a pool of threads in this process.
+        fan_out_pool = ThreadPool(self.fan_out) if self.fan_out and self.fan_out > 1 else None
+
         # Ingest each file in the file list.
         previous_data_file = ""
+        sent = 0
         for data_file, routes in files:
+            # Leave the rest of the files if ingestion is stopping.
+            if self.stopping.is_set():
+                break
+            sent += 1
+            fan_out = fan_out_pool and len(routes) > 1
+            results = []
             for r in routes:
+                """ Check if the EDEX services were running when the health monitor last checked.
+                    If not, wait for them (and attempt to restart them). """
+                if not self.no_edex and (not fan_out or r is routes[0]):
+                    self.health_monitor.wait(previous_data_file)
+                wait_to_send(r['uframe_route'])
+                if not fan_out:
+                    results.append(send_to_route((data_file, r)))
+                    previous_data_file = data_file
+            if fan_out:
+                results = fan_out_pool.map(send_to_route, [(data_file, r) for r in routes])
+
+            record_failures()
+            for r, e in zip(routes, results):
                 uframe_route = r['uframe_route']
                 reference_designator = r['reference_designator']
                 data_source = r['data_source']
-
-                # Check if the EDEX services are still running. If not, attempt to restart them.
-                if not self.no_edex:
-                    self.service_manager.wait_until_ready(previous_data_file)
                 ingestion_command = ("ingestsender",
                     uframe_route, data_file, reference_designator, data_source, deployment_number)
-                try:
-                    # Attempt to send the data file over QPID to uFrame.
-                    ingestion_command_string = " ".join(ingestion_command)
-                    if self.test_mode:
-                        ingestion_command_string = "TEST MODE: " + ingestion_command_string
-                    else:
-                        self.get_qpid_sender(uframe_route).send(
-                            data_file, "text/plain", 
-                            reference_designator, data_source, deployment_number)
-                except qm.exceptions.MessagingError as e:
+                ingestion_command_string = " ".join(ingestion_command)
+                if self.test_mode:
+                    ingestion_command_string = "TEST MODE: " + ingestion_command_string
+                if e is not None:
                     # Log any qpid errors
                     self.logger.error(
                         "There was a problem with qpid when ingesting %s (Exception %s)." % (
@@ -607,13 +1399,50 @@ class Ingestor(object):
                     self.failed_ingestions.append(
                         annotate_parameters(
                             data_file, uframe_route, reference_designator, data_source))
+                    failed_routes.add(uframe_route)
                 else:
                     # If there are no errors, consider the ingest send a success and log it.
                     self.logger.info(
                         "PID: %s | %s" % (str(sender_process.pid), ingestion_command_string))
-                previous_data_file = data_file
-            sleep(self.sleep)
-        return True
+                    if self.high_water_marks and not self.test_mode:
+                        newest_file = (self.listing_cache.mtime(data_file), data_file)
+                        if newest_file[0] and newest_file > newest_files.get(uframe_route):
+                            newest_files[uframe_route] = newest_file
+            previous_data_file = data_file
+
+            # Without any rate limits, fall back to the sleep timer between files.
+            if not self.rate_limiter.limited():
+                sleep(self.sleep)
+
+        if fan_out_pool:
+            fan_out_pool.close()
+            fan_out_pool.join()
+
+        # Track the files left unsent, which also keeps their routes' high water marks down.
+        unsent = list(files[sent:])
+        if unsent:
+            self.logger.warning("Ingestion stopped with %s file(s) left unsent." % len(unsent))
+            self.fail_files(unsent)
+            for data_file, routes in unsent:
+                failed_routes.update(r['uframe_route'] for r in routes)
+
+        # Wait for the messages this call sent that are still in flight to be settled.
+        used_routes = set(r['uframe_route'] for data_file, routes in files[:sent] for r in routes)
+        for uframe_route in used_routes:
+            qpid_sender = self.qpid_senders.get(uframe_route)
+            if qpid_sender is not None:
+                with qpid_sender.lock:
+                    deliver(qpid_sender.sync())
+        record_failures()
+
+        """ Raise the high water marks to the newest files sent. Failures of asynchronous sends are
+            only known after later files were sent, so the marks of routes with any failed send
+            are left where they were, and the failed files are considered again next time. """
+        if mask:
+            for uframe_route, (mtime, data_file) in newest_files.iteritems():
+                if uframe_route not in failed_routes and uframe_route not in held_routes:
+                    self.high_water_marks.update(mask, uframe_route, mtime, data_file)
+        return sent, failed_routes
 
     def write_failures_to_csv(self, label):
         """ Write any failed ingestions out into a CSV file that can be re-ingested later. """
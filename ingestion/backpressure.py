@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+from uuid import uuid4
+
+from qpid import messaging as qm
+
+QMF_ADDRESS = "qmf.default.direct/broker"
+QUEUE_OBJECT_NAME = "org.apache.qpid.broker:queue:%s"
+
+
+class QmfQueueDepths(object):
+    """ Reads the depth of a queue from the broker's QMF management agent, opening the
+        connection again after an error or in a forked process. """
+
+    def __init__(self, host="localhost", port=5672, user="guest", password="guest", timeout=10):
+        self.host = str(host)
+        self.port = port
+        self.user = str(user)
+        self.password = str(password)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def open_connection(self):
+        connection = qm.Connection(
+            host=self.host, port=self.port, username=self.user, password=self.password)
+        connection.open()
+        return connection
+
+    def connect(self):
+        self.connection = self.open_connection()
+        self.pid = os.getpid()
+        self.session = self.connection.session()
+        self.reply_to = "qmf.default.topic/direct.%s;{node:{type:topic}}" % uuid4()
+        self.receiver = self.session.receiver(self.reply_to)
+        self.sender = self.session.sender(QMF_ADDRESS)
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            try:
+                self.connection.close(timeout=5)
+            except Exception:
+                pass
+        self.connection = None
+
+    def __call__(self, queue):
+        """ Return the number of messages in the queue, or None if the broker has no such queue.
+            """
+        with self.lock:
+            return self.query(queue)
+
+    def query(self, queue):
+        if self.connection is None or self.pid != os.getpid():
+            self.connect()
+        correlation_id = str(uuid4())
+        try:
+            self.sender.send(qm.Message(
+                {'_what': 'OBJECT', '_object_id': {'_object_name': QUEUE_OBJECT_NAME % queue}},
+                reply_to=self.reply_to, correlation_id=correlation_id, subject='broker',
+                properties={
+                    'method': 'request',
+                    'qmf.opcode': '_query_request',
+                    'x-amqp-0-10.app-id': 'qmf2',
+                    }))
+            while True:
+                response = self.receiver.fetch(timeout=self.timeout)
+                self.session.acknowledge(response)
+                if response.correlation_id == correlation_id:
+                    break
+        except (qm.exceptions.MessagingError, qm.exceptions.Timeout):
+            self.close()
+            raise
+        if not response.content:
+            return None
+        return response.content[0]['_values']['msgDepth']
+
+
+class Backpressure(object):
+    """ Pauses sending to a queue from when its depth (read by the depths callable) reaches the
+        high watermark until it falls to the low watermark. """
+
+    def __init__(self, depths, high_watermark, low_watermark=None, interval=5):
+        self.logger = logging.getLogger('Backpressure')
+        self.depths = depths
+        self.high_watermark = high_watermark
+        self.low_watermark = high_watermark // 2 if low_watermark is None else low_watermark
+        self.interval = interval
+        self.checked = {}
+        self.lock = threading.Lock()
+        self.queue_locks = {}
+
+    def depth(self, queue):
+        try:
+            return self.depths(queue)
+        except Exception as e:
+            self.logger.warning("Could not read the depth of %s (%s)." % (queue, e))
+            return None
+
+    def wait(self, queue):
+        """ Wait until the queue is below its high watermark (or has drained to its low watermark
+            after reaching it). Returns the time spent waiting. """
+        with self.lock:
+            queue_lock = self.queue_locks.setdefault(queue, threading.Lock())
+        with queue_lock:
+            return self.drain(queue)
+
+    def drain(self, queue):
+        now = time.time()
+        if now - self.checked.get(queue, 0) < self.interval:
+            return 0
+        self.checked[queue] = now
+        depth = self.depth(queue)
+        if depth is None or depth < self.high_watermark:
+            return 0
+
+        self.logger.warning(
+            "%s holds %s messages (high watermark %s), pausing until it drains to %s." % (
+                queue, depth, self.high_watermark, self.low_watermark))
+        while depth is not None and depth > self.low_watermark:
+            time.sleep(self.interval)
+            depth = self.depth(queue)
+        self.checked[queue] = time.time()
+        time_elapsed = time.time() - now
+        self.logger.info("%s holds %s messages, resuming after %.1f seconds." % (
+            queue, depth, time_elapsed))
+        return time_elapsed
@@ -0,0 +1,71 @@
+import os
+import math
+import struct
+import hashlib
+
+MAGIC = "BLMF"
+VERSION = 1
+HEADER = struct.Struct("<4sHQdQIQ")
+DIGEST = struct.Struct("<QQ")
+
+
+class BloomFilter(object):
+    """ A compact, probabilistic set that can tell that an item is definitely not in it, or that
+        it might be (wrongly, at most error_rate of the time while it holds capacity items). """
+
+    def __init__(self, capacity, error_rate=0.01, entries=0):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.entries = entries
+        self.bit_count = int(math.ceil(
+            -self.capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        self.hash_count = max(int(round(self.bit_count * math.log(2) / self.capacity)), 1)
+        self.bits = bytearray((self.bit_count + 7) // 8)
+
+    def positions(self, item):
+        first, second = DIGEST.unpack(hashlib.md5(item).digest())
+        return [(first + i * second) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self.positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def save(self, path):
+        """ Write the filter to a file, replacing any previous version atomically. """
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as outfile:
+            outfile.write(HEADER.pack(
+                MAGIC, VERSION, self.capacity, self.error_rate, self.bit_count, self.hash_count,
+                self.entries))
+            outfile.write(self.bits)
+        os.rename(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Read a filter written by save. Raises IOError if the file can't be read and
+            ValueError if it isn't a complete Bloom filter file. """
+        with open(path, "rb") as infile:
+            header = infile.read(HEADER.size)
+            if len(header) != HEADER.size:
+                raise ValueError("%s is not a Bloom filter." % path)
+            magic, version, capacity, error_rate, bit_count, hash_count, entries = HEADER.unpack(
+                header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a Bloom filter." % path)
+            bloom_filter = cls.__new__(cls)
+            bloom_filter.capacity = capacity
+            bloom_filter.error_rate = error_rate
+            bloom_filter.entries = entries
+            bloom_filter.bit_count = bit_count
+            bloom_filter.hash_count = hash_count
+            bloom_filter.bits = bytearray(infile.read())
+        if len(bloom_filter.bits) != (bit_count + 7) // 8:
+            raise ValueError("%s is not a complete Bloom filter." % path)
+        return bloom_filter
@@ -0,0 +1,120 @@
+import re
+import gzip
+import zlib
+import zipfile
+
+FINISHED_PROCESSING = "Finished Processing file"
+
+TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}")
+
+ROUTE = re.compile(r"Ingest\.[\w.\-]+")
+THREAD_SUFFIX = re.compile(r"-\d+$")
+
+# The leading bytes of gzip and zip files.
+GZIP_SIGNATURE = "\x1f\x8b"
+ZIP_SIGNATURE = "PK\x03\x04"
+
+# The number of bytes read from a log at a time.
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# The errors raised when reading a truncated or corrupt log.
+READ_ERRORS = (IOError, EOFError, zlib.error, zipfile.BadZipfile)
+
+
+def parse_line(line):
+    """ Parse a "Finished Processing file" line from an EDEX log into a (timestamp, uframe_route,
+        filename) tuple. The uframe_route is stripped of any thread number suffix EDEX adds to it.
+        Returns None if the line doesn't describe a finished ingestion. """
+    head, found, tail = line.partition(FINISHED_PROCESSING)
+    if not found:
+        return None
+    route = ROUTE.search(head)
+    filename = tail.lstrip(":").split(None, 1)
+    if not route or not filename:
+        return None
+    timestamp = TIMESTAMP.search(head)
+    return (
+        timestamp.group(0) if timestamp else None,
+        THREAD_SUFFIX.sub("", route.group(0)),
+        filename[0].strip("'\""))
+
+
+def is_compressed(log_file):
+    """ Check if a log file is gzip or zip compressed (rotated EDEX logs usually are). """
+    with open(log_file, "rb") as infile:
+        return infile.read(4).startswith((GZIP_SIGNATURE, ZIP_SIGNATURE))
+
+
+class LogReader(object):
+    """ Streams the "Finished Processing file" lines out of a plain, gzip or zip compressed EDEX log
+        in large chunks. Uncompressed logs can be read from a byte offset, which is left after the
+        last complete line read. """
+
+    def __init__(self, log_file, offset=0, chunk_size=CHUNK_SIZE):
+        self.log_file = log_file
+        self.offset = offset
+        self.chunk_size = chunk_size
+
+    def streams(self):
+        """ Yield the open, decompressed streams of the log (a zip archive may hold several) along
+            with whether the stream is complete, which is only assumed of compressed logs. """
+        with open(self.log_file, "rb") as infile:
+            signature = infile.read(4)
+            if not signature.startswith((GZIP_SIGNATURE, ZIP_SIGNATURE)):
+                infile.seek(self.offset)
+                yield infile, False
+                return
+        if self.offset:
+            raise ValueError("Compressed logs can only be read from the start: %s" % self.log_file)
+        if signature.startswith(GZIP_SIGNATURE):
+            stream = gzip.open(self.log_file, "rb")
+            try:
+                yield stream, True
+            finally:
+                stream.close()
+        else:
+            archive = zipfile.ZipFile(self.log_file)
+            try:
+                for member in archive.infolist():
+                    stream = archive.open(member)
+                    try:
+                        yield stream, True
+                    finally:
+                        stream.close()
+            finally:
+                archive.close()
+
+    def chunks(self):
+        """ Yield chunks of the log that each end on a complete line. """
+        for stream, complete in self.streams():
+            remainder = ""
+            while True:
+                data = stream.read(self.chunk_size)
+                if not data:
+                    break
+                data = remainder + data
+                end = data.rfind("\n") + 1
+                remainder = data[end:]
+                if end:
+                    self.offset += end
+                    yield data[:end]
+            if remainder and complete:
+                yield remainder + "\n"
+
+    def lines(self):
+        """ Yield the "Finished Processing file" lines of the log. """
+        for chunk in self.chunks():
+            position = chunk.find(FINISHED_PROCESSING)
+            while position != -1:
+                start = chunk.rfind("\n", 0, position) + 1
+                end = chunk.find("\n", position) + 1
+                yield chunk[start:end]
+                position = chunk.find(FINISHED_PROCESSING, end)
+
+    def records(self):
+        """ Yield a (timestamp, uframe_route, filename) tuple for each file EDEX finished
+            processing according to the log. """
+        for line in self.lines():
+            record = parse_line(line)
+            if record:
+                yield record
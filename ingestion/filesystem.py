@@ -0,0 +1,182 @@
+import os
+import re
+import stat
+import fnmatch
+import calendar
+from datetime import datetime
+from glob import has_magic
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+YEAR = re.compile(r"^(19|20)\d{2}$")
+MONTH = re.compile(r"^(0[1-9]|1[0-2])$")
+DAY = re.compile(r"^(0[1-9]|[12]\d|3[01])$")
+DATE = re.compile(r"^((?:19|20)\d{2})-?(0[1-9]|1[0-2])-?(0[1-9]|[12]\d|3[01])$")
+
+# How long after a directory last changed (or either side of the dates in its path) its files are
+# assumed to still be written to. A day also covers the offset between UTC and local time.
+PRUNE_SLACK = 86400
+
+
+def match_names(names, pattern):
+    """ Return the names matching the pattern, following glob's rules for hidden files. """
+    names = fnmatch.filter(names, pattern)
+    if not pattern.startswith("."):
+        names = [n for n in names if not n.startswith(".")]
+    return names
+
+
+def path_dates(path):
+    """ Return the (first, last) timestamps of the dates a directory's path places it in, from a
+        YYYYMMDD or YYYY-MM-DD component or from YYYY, YYYY/MM or YYYY/MM/DD components, or None
+        if the path has no dates. The dates are taken to be in UTC. """
+    date = []
+    # Months and days only count straight after the year or month they belong to.
+    contiguous = False
+    for component in path.split("/"):
+        match = DATE.match(component)
+        if match:
+            date, contiguous = [int(g) for g in match.groups()], False
+        elif YEAR.match(component):
+            date, contiguous = [int(component)], True
+        elif contiguous and len(date) < 3 and (MONTH if len(date) == 1 else DAY).match(component):
+            date.append(int(component))
+        else:
+            contiguous = False
+    if not date:
+        return None
+
+    if len(date) == 1:
+        first, last = datetime(date[0], 1, 1), datetime(date[0] + 1, 1, 1)
+    elif len(date) == 2:
+        first = datetime(date[0], date[1], 1)
+        last = datetime(date[0] + date[1] // 12, date[1] % 12 + 1, 1)
+    else:
+        try:
+            first = datetime(*date)
+        except ValueError:
+            return None
+        last = datetime.fromordinal(first.toordinal() + 1)
+    return calendar.timegm(first.timetuple()), calendar.timegm(last.timetuple())
+
+
+class ListingCache(object):
+    """ A run-scoped cache of directory listings and file modification times, so each directory is
+        listed and each file statted once however many filename masks touch them. Directories that
+        can't hold files modified between the start and end are pruned without being listed. """
+
+    def __init__(self, start=None, end=None):
+        self.start = start
+        self.end = end
+        self.listings = {}
+        self.mtimes = {}
+        self.masks = {}
+        self.pruned_directories = set()
+
+    def listing(self, directory):
+        """ Return a dict of the directory's entries by name. """
+        listing = self.listings.get(directory)
+        if listing is None:
+            listing = {}
+            try:
+                for entry in scandir(directory or os.curdir):
+                    listing[entry.name] = entry
+            except OSError:
+                pass
+            self.listings[directory] = listing
+        return listing
+
+    def is_directory(self, path):
+        parent, name = os.path.split(path)
+        if not name:
+            return os.path.isdir(path)
+        entry = self.listing(parent).get(name)
+        try:
+            return entry is not None and entry.is_dir()
+        except OSError:
+            return False
+
+    def mtime(self, path, entry=None):
+        """ Return the modification time of a file, or None if it isn't a file. """
+        if path not in self.mtimes:
+            mtime = None
+            try:
+                if entry is None:
+                    path_stat = os.stat(path)
+                    if not stat.S_ISDIR(path_stat.st_mode):
+                        mtime = path_stat.st_mtime
+                elif not entry.is_dir():
+                    mtime = entry.stat().st_mtime
+            except OSError:
+                # The file was removed after the directory was listed.
+                pass
+            self.mtimes[path] = mtime
+        return self.mtimes[path]
+
+    def pruned(self, directory, files=False):
+        """ Check if the directory can be skipped because none of the files under it (or, if files
+            is set, directly in it) can have been modified between the start and end. """
+        if self.start is None and self.end is None:
+            return False
+        pruned = False
+        dates = path_dates(directory)
+        if dates:
+            first, last = dates
+            pruned = ((self.end is not None and first - PRUNE_SLACK >= self.end)
+                or (self.start is not None and last + PRUNE_SLACK <= self.start))
+        if not pruned and files and self.start is not None:
+            parent, name = os.path.split(directory)
+            entry = self.listings.get(parent, {}).get(name)
+            try:
+                mtime = entry.stat().st_mtime if entry else os.stat(directory).st_mtime
+                pruned = mtime + PRUNE_SLACK <= self.start
+            except OSError:
+                pass
+        if pruned:
+            self.pruned_directories.add(directory)
+        return pruned
+
+    def directories(self, directory):
+        """ Return the directories matching a directory mask, leaving out pruned directories. """
+        if not has_magic(directory):
+            if not directory:
+                return [directory]
+            return [directory] if self.is_directory(directory) and not self.pruned(directory) else []
+        parent, pattern = os.path.split(directory)
+        if not pattern:
+            return self.directories(parent)
+        directories = []
+        for d in self.directories(parent):
+            listing = self.listing(d)
+            for name in match_names(listing.keys(), pattern):
+                path = os.path.join(d, name)
+                try:
+                    if listing[name].is_dir() and not self.pruned(path):
+                        directories.append(path)
+                except OSError:
+                    continue
+        return directories
+
+    def scan(self, mask):
+        """ Return sorted (path, mtime) tuples for every file matching the filename mask. """
+        if mask not in self.masks:
+            directory, pattern = os.path.split(mask)
+            files = []
+            for d in self.directories(directory):
+                if self.pruned(d, files=True):
+                    continue
+                if has_magic(pattern):
+                    listing = self.listing(d)
+                    paths = [(os.path.join(d, n), listing[n])
+                        for n in match_names(listing.keys(), pattern)]
+                else:
+                    paths = [(os.path.join(d, pattern), None)]
+                for path, entry in paths:
+                    mtime = self.mtime(path, entry)
+                    if mtime is not None:
+                        files.append((path, mtime))
+            self.masks[mask] = sorted(files)
+        return list(self.masks[mask])
@@ -0,0 +1,208 @@
+import os
+import time
+import random
+import logging
+import threading
+import multiprocessing
+
+import requests
+
+from config import EDEX
+
+HEALTH_MONITOR_INTERVAL = EDEX.get('health_monitor_interval', 5)
+
+# Circuit breaker states.
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+STATE_NAMES = {CLOSED: "closed", OPEN: "open", HALF_OPEN: "half-open"}
+
+
+class HealthCheck(object):
+    """ Checks the uFrame health check URL over a keep-alive session, with a circuit breaker
+        that stops checking for reset_timeout seconds after failure_threshold failed checks. """
+
+    def __init__(self, url=EDEX['health_check_url'],
+            timeout=EDEX.get('health_check_timeout', 10),
+            backoff=EDEX.get('health_check_backoff', 1),
+            max_backoff=EDEX.get('health_check_max_backoff', 60),
+            failure_threshold=EDEX.get('health_check_failures', 3),
+            reset_timeout=EDEX.get('health_check_reset', 30)):
+        self.logger = logging.getLogger('Health')
+        self.url = url
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.session = None
+        self.pid = None
+
+        self.state = multiprocessing.Value('i', CLOSED)
+        self.failures = multiprocessing.Value('i', 0, lock=False)
+        self.opened_at = multiprocessing.Value('d', 0, lock=False)
+        self.probed_at = multiprocessing.Value('d', 0, lock=False)
+
+    def request(self):
+        if self.session is None or self.pid != os.getpid():
+            self.session = requests.Session()
+            self.pid = os.getpid()
+        try:
+            return self.session.get(self.url, timeout=self.timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def set_state(self, state):
+        if self.state.value != state:
+            self.logger.info("uFrame health check circuit is %s." % STATE_NAMES[state])
+        self.state.value = state
+        if state == OPEN:
+            self.opened_at.value = time.time()
+        elif state == HALF_OPEN:
+            self.probed_at.value = time.time()
+        elif state == CLOSED:
+            self.failures.value = 0
+
+    def check(self):
+        """ Check uFrame once, unless the circuit is open. Returns True if the check passed. """
+        with self.state.get_lock():
+            now = time.time()
+            if ((self.state.value == OPEN and now - self.opened_at.value >= self.reset_timeout)
+                    or (self.state.value == HALF_OPEN
+                        and now - self.probed_at.value >= 2 * self.timeout)):
+                self.set_state(HALF_OPEN)
+                probe = True
+            elif self.state.value == CLOSED:
+                probe = False
+            else:
+                return False
+
+        passed = False
+        try:
+            passed = self.request()
+        finally:
+            # Settle the probe even if the request raised, so the circuit isn't left half-open.
+            with self.state.get_lock():
+                if passed:
+                    self.set_state(CLOSED)
+                elif probe:
+                    self.set_state(OPEN)
+                elif self.state.value == CLOSED:
+                    self.failures.value += 1
+                    if self.failures.value >= self.failure_threshold:
+                        self.set_state(OPEN)
+        return passed
+
+    def delay(self, attempt):
+        """ Return how long to wait before the next check: an exponential backoff with full
+            jitter, but no sooner than an open circuit will let a probe through. """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if self.state.value == OPEN:
+            delay = max(delay, self.opened_at.value + self.reset_timeout - time.time()
+                + random.uniform(0, self.backoff))
+        return delay
+
+    def wait(self):
+        """ Wait until the health check passes. """
+        attempt = 0
+        while not self.check():
+            if not attempt:
+                self.logger.warn("uFrame Health Check failed, pausing ingestion.")
+            time.sleep(self.delay(attempt))
+            attempt += 1
+        if attempt:
+            self.logger.info("uFrame Health Check passed after %s attempts, resuming ingestion." % (
+                attempt + 1))
+
+
+class HealthMonitor(object):
+    """ Checks the health of the EDEX services in a background thread every interval seconds, so
+        senders only wait for the services when the last check found them unhealthy. """
+
+    def __init__(self, service_manager, interval=HEALTH_MONITOR_INTERVAL):
+        self.logger = logging.getLogger('Health')
+        self.service_manager = service_manager
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.healthy = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+
+        # Metrics
+        self.checks = 0
+        self.check_time = 0
+        self.blocked_time = 0
+
+    def start(self):
+        if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.check()
+            self.thread = threading.Thread(target=self.run, name="HealthMonitor")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread and self.pid == os.getpid():
+            self.thread.join()
+
+    def check(self):
+        """ Check the services once and publish the result. """
+        start_time = time.time()
+        try:
+            healthy = self.service_manager.healthy()
+        except (Exception, SystemExit):
+            # Leave it to a blocked sender to report the error (and exit if it persists).
+            healthy = False
+        self.checks += 1
+        self.check_time += time.time() - start_time
+        if healthy:
+            self.healthy.set()
+        else:
+            if self.healthy.is_set():
+                self.logger.warning("One or more EDEX services are unhealthy.")
+            self.healthy.clear()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def wait(self, previous_data_file):
+        """ Return immediately if the services were healthy when last checked, otherwise wait for
+            them to be ready. Returns the time spent waiting. """
+        self.start()
+        if self.healthy.is_set():
+            return 0
+        start_time = time.time()
+        with self.lock:
+            if not self.healthy.is_set():
+                self.service_manager.wait_until_ready(previous_data_file)
+                self.healthy.set()
+        time_elapsed = time.time() - start_time
+        self.blocked_time += time_elapsed
+        return time_elapsed
+
+    def take_metrics(self):
+        """ Return the metrics gathered since they were last taken, and start them again from
+            zero. A sender process's metrics are taken after each batch and added to its parent's.
+            """
+        metrics = {
+            'checks': self.checks, 'check_time': self.check_time, 'blocked_time': self.blocked_time}
+        self.checks, self.check_time, self.blocked_time = 0, 0, 0
+        return metrics
+
+    def add_metrics(self, metrics):
+        self.checks += metrics['checks']
+        self.check_time += metrics['check_time']
+        self.blocked_time += metrics['blocked_time']
+
+    def log_metrics(self):
+        if self.checks:
+            self.logger.info((
+                "%s health checks took %.2f seconds (%.3f seconds each); "
+                "senders were blocked for %.2f seconds.") % (
+                self.checks, self.check_time, self.check_time / self.checks, self.blocked_time))
@@ -0,0 +1,81 @@
+import os
+import sqlite3
+
+from config import EDEX
+
+HIGH_WATER_MARK_FILE = "/".join((EDEX['processed_log_path'], "high_water_marks.db"))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS high_water_marks (
+        filename_mask TEXT NOT NULL,
+        uframe_route TEXT NOT NULL,
+        mtime REAL NOT NULL,
+        filename TEXT NOT NULL,
+        PRIMARY KEY (filename_mask, uframe_route)
+        );
+    """
+
+
+class HighWaterMarks(object):
+    """ A persistent record of the newest file (by modification time, then filename) sent for
+        each filename mask and uframe_route, so later runs only need to consider newer files. """
+
+    def __init__(self, path=HIGH_WATER_MARK_FILE):
+        self.path = path
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        connection = self.connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.text_factory = str
+        return connection
+
+    def get(self, filename_mask, uframe_route):
+        """ Return the (mtime, filename) high water mark for the filename mask and uframe_route,
+            or None if nothing has been sent for them. """
+        connection = self.connect()
+        try:
+            return connection.execute(
+                "SELECT mtime, filename FROM high_water_marks "
+                "WHERE filename_mask = ? AND uframe_route = ?",
+                (filename_mask, uframe_route)).fetchone()
+        finally:
+            connection.close()
+
+    def update(self, filename_mask, uframe_route, mtime, filename):
+        """ Raise the high water mark to the file, unless it is already at a newer file. """
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR IGNORE INTO high_water_marks VALUES (?, ?, ?, ?)",
+                    (filename_mask, uframe_route, mtime, filename))
+                connection.execute(
+                    "UPDATE high_water_marks SET mtime = ?, filename = ? "
+                    "WHERE filename_mask = ? AND uframe_route = ? "
+                    "AND (mtime < ? OR (mtime = ? AND filename < ?))",
+                    (mtime, filename, filename_mask, uframe_route, mtime, mtime, filename))
+        finally:
+            connection.close()
+
+    def rewind(self, filename_mask, uframe_route, mtime=None):
+        """ Lower the high water mark to just before mtime, or remove it if mtime is None. """
+        connection = self.connect()
+        try:
+            with connection:
+                if mtime is None:
+                    connection.execute(
+                        "DELETE FROM high_water_marks "
+                        "WHERE filename_mask = ? AND uframe_route = ?",
+                        (filename_mask, uframe_route))
+                else:
+                    connection.execute(
+                        "UPDATE high_water_marks SET mtime = ?, filename = '' "
+                        "WHERE filename_mask = ? AND uframe_route = ? AND mtime >= ?",
+                        (mtime, filename_mask, uframe_route, mtime))
+        finally:
+            connection.close()
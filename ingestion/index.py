@@ -0,0 +1,178 @@
+import os
+import re
+import sqlite3
+import logging
+
+from config import EDEX
+from processed_logs import ProcessedLog, is_processed_log, convert_processed_log
+from bloom import BloomFilter
+
+INDEX_FILE = EDEX.get('index_file') or "/".join((EDEX['processed_log_path'], "ingested_files.db"))
+BLOOM_FILTER_PATH = "/".join((EDEX['processed_log_path'], "bloom_filters"))
+
+# The smallest number of entries a route's Bloom filter is sized for.
+MINIMUM_FILTER_CAPACITY = 100000
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS ingested (
+        uframe_route TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        timestamp TEXT,
+        PRIMARY KEY (uframe_route, filename)
+        );
+    CREATE TABLE IF NOT EXISTS processed_logs (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL
+        );
+    """
+
+
+def literal_prefix(mask):
+    """ Return the part of a filename mask before its first wildcard. """
+    return re.split(r"[*?\[]", mask, 1)[0]
+
+
+class IngestedFileIndex(object):
+    """ A persistent on-disk index of the files EDEX has finished processing, keyed by
+        (uframe_route, filename), with optional Bloom filters per uframe_route in front of it. """
+
+    def __init__(self, path=INDEX_FILE, bloom_filters=EDEX.get('bloom_filters', False),
+            error_rate=EDEX.get('bloom_error_rate', 0.01)):
+        self.logger = logging.getLogger('Index')
+        self.path = path
+        self.error_rate = error_rate
+        self.filters = {} if bloom_filters else None
+        self.modified_filters = set()
+        if bloom_filters and not os.path.exists(BLOOM_FILTER_PATH):
+            os.makedirs(BLOOM_FILTER_PATH)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.text_factory = str
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, processed_log_files):
+        """ Add any lines written to the processed EDEX logs since the last update to the index.
+            Returns the number of new entries. """
+        added = 0
+        for log_file in processed_log_files:
+            if not is_processed_log(log_file):
+                # The log the file was processed from may be gone, so convert it here.
+                convert_processed_log(log_file)
+                self.logger.info("%s has been converted to the compact format." % log_file)
+            added += self.update_from_file(log_file)
+        self.save_filters()
+        self.logger.info(
+            "%s new entries added to the ingested file index (%s)." % (added, self.path))
+        return added
+
+    def update_from_file(self, log_file):
+        """ Read a single processed EDEX log into the index if it has changed since the previous
+            update. Processed logs are small and already parsed, so a changed log is read in full
+            and only entries that are new to the index are added. """
+        log_file_stat = os.stat(log_file)
+        source = self.connection.execute(
+            "SELECT size, mtime FROM processed_logs WHERE path = ?", (log_file, )).fetchone()
+        if source == (log_file_stat.st_size, log_file_stat.st_mtime):
+            return 0
+
+        processed_log = ProcessedLog(log_file)
+        entries = {}
+        for timestamp, uframe_route, filename in processed_log.records():
+            entries.setdefault(uframe_route, []).append((uframe_route, filename, timestamp))
+        processed_log.close()
+
+        added = 0
+        with self.connection:
+            for uframe_route in entries:
+                if self.filters is not None:
+                    # Bring the filter in step with the index before adding the new entries.
+                    bloom_filter = self.route_filter(uframe_route)
+                route_added = max(self.connection.executemany(
+                    "INSERT OR IGNORE INTO ingested (uframe_route, filename, timestamp) "
+                    "VALUES (?, ?, ?)", entries[uframe_route]).rowcount, 0)
+                if self.filters is not None and route_added:
+                    for entry in entries[uframe_route]:
+                        bloom_filter.add(entry[1])
+                    bloom_filter.entries += route_added
+                    self.modified_filters.add(uframe_route)
+                added += route_added
+            self.connection.execute(
+                "INSERT OR REPLACE INTO processed_logs (path, size, mtime) VALUES (?, ?, ?)",
+                (log_file, log_file_stat.st_size, log_file_stat.st_mtime))
+        return added
+
+    def filter_path(self, uframe_route):
+        return "/".join((BLOOM_FILTER_PATH, uframe_route + ".bloom"))
+
+    def count(self, uframe_route):
+        """ Return the number of files EDEX has finished processing for the uframe_route. """
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM ingested WHERE uframe_route = ?", (uframe_route, )).fetchone()[0]
+
+    def build_filter(self, uframe_route):
+        """ Build a new Bloom filter for the uframe_route from the index and save it. The filter is
+            sized for twice the route's current entries so it can grow before it is rebuilt. """
+        bloom_filter = BloomFilter(
+            max(2 * self.count(uframe_route), MINIMUM_FILTER_CAPACITY), self.error_rate)
+        for row in self.connection.execute(
+                "SELECT filename FROM ingested WHERE uframe_route = ?", (uframe_route, )):
+            bloom_filter.add(row[0])
+            bloom_filter.entries += 1
+        bloom_filter.save(self.filter_path(uframe_route))
+        self.logger.info("Built a Bloom filter for %s with %s entries." % (
+            uframe_route, bloom_filter.entries))
+        return bloom_filter
+
+    def route_filter(self, uframe_route):
+        """ Return the Bloom filter for the uframe_route, loading it from disk (or rebuilding it if
+            it isn't usable) the first time it is needed. """
+        bloom_filter = self.filters.get(uframe_route)
+        if bloom_filter is None:
+            try:
+                bloom_filter = BloomFilter.load(self.filter_path(uframe_route))
+            except (IOError, ValueError):
+                bloom_filter = None
+            if (bloom_filter is None
+                    or bloom_filter.entries != self.count(uframe_route)
+                    or bloom_filter.entries > bloom_filter.capacity
+                    or bloom_filter.error_rate != self.error_rate):
+                bloom_filter = self.build_filter(uframe_route)
+            self.filters[uframe_route] = bloom_filter
+        return bloom_filter
+
+    def save_filters(self):
+        """ Save the Bloom filters that new entries were added to. A filter is rebuilt instead if
+            it has outgrown its capacity, or if another process added entries to the index for its
+            route at the same time. """
+        for uframe_route in self.modified_filters:
+            bloom_filter = self.filters[uframe_route]
+            if (bloom_filter.entries != self.count(uframe_route)
+                    or bloom_filter.entries > bloom_filter.capacity):
+                self.filters[uframe_route] = self.build_filter(uframe_route)
+            else:
+                bloom_filter.save(self.filter_path(uframe_route))
+        self.modified_filters.clear()
+
+    def contains(self, uframe_route, filename):
+        """ Check if EDEX has finished processing the file for the uframe_route. """
+        if self.filters is not None and filename not in self.route_filter(uframe_route):
+            return False
+        return self.connection.execute(
+            "SELECT 1 FROM ingested WHERE uframe_route = ? AND filename = ?",
+            (uframe_route, filename)).fetchone() is not None
+
+    def ingested_files(self, uframe_route, mask):
+        """ Return the sorted names of all files matching the mask that EDEX has finished
+            processing for the uframe_route. """
+        prefix = literal_prefix(mask)
+        return [row[0] for row in self.connection.execute(
+            "SELECT filename FROM ingested WHERE uframe_route = ? "
+            "AND filename >= ? AND filename < ? AND filename GLOB ? ORDER BY filename",
+            (uframe_route, prefix, prefix + "\xff", mask))]
@@ -0,0 +1,50 @@
+import os
+import time
+import logging
+
+import yaml
+
+JOBS_CONFIG_FILE = "jobs.yml"
+
+# How often (in seconds) the jobs config file is checked for changes.
+RELOAD_INTERVAL = 1
+
+
+class JobsConfig(object):
+    """ The settings in the jobs config file, read again whenever the file changes so they can be
+        adjusted while the script is running. """
+
+    def __init__(self, config_file=JOBS_CONFIG_FILE):
+        self.logger = logging.getLogger('JobsConfig')
+        self.config_file = config_file
+        self.settings = {}
+        self.last_updated = None
+        self.last_checked = 0
+
+    def reload(self):
+        """ Read the file again if it has changed since it was read. Returns True if the settings
+            changed; if the file can't be read, the previous settings are kept. """
+        if time.time() - self.last_checked < RELOAD_INTERVAL:
+            return False
+        self.last_checked = time.time()
+        last_updated = None
+        if os.path.isfile(self.config_file):
+            last_updated = os.path.getmtime(self.config_file)
+        if last_updated == self.last_updated:
+            return False
+        self.last_updated = last_updated
+
+        settings = {}
+        if last_updated:
+            try:
+                with open(self.config_file) as config_file:
+                    settings = dict(yaml.safe_load(config_file) or {})
+            except Exception:
+                self.logger.exception(
+                    "Could not read %s, keeping the previous settings." % self.config_file)
+                return False
+        self.settings = settings
+        return True
+
+    def get(self, section, default=None):
+        return self.settings.get(section) or default
@@ -0,0 +1,201 @@
+import os
+import mmap
+import struct
+import time
+import calendar
+
+from edex_logs import LogReader
+
+# Processed EDEX logs are stored in a compact binary format: a header, a table of the distinct
+# uframe_routes in the log, a table of restart offsets and the entries themselves. Entries are
+# sorted by filename (then route) and each filename is stored as the length of the prefix it
+# shares with the previous entry's filename plus the rest of the filename. Every
+# RESTART_INTERVAL entries the full filename is stored and its offset recorded in the restart
+# table, so a filename can be found by bisecting the restart table and scanning a few entries.
+#
+# Header:  magic, version, restart interval, route count, entry count, restart count
+# Routes:  length, route
+# Restart: offset of the entry relative to the first entry
+# Entry:   shared prefix length, suffix length, route number, timestamp, suffix
+
+MAGIC = "EDXP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIII")
+ROUTE_LENGTH = struct.Struct("<H")
+OFFSET = struct.Struct("<I")
+ENTRY = struct.Struct("<HHHI")
+
+RESTART_INTERVAL = 16
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def is_processed_log(path):
+    """ Check if the file is a processed log in the compact format. """
+    with open(path, "rb") as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+
+def encode_timestamp(timestamp, days={}):
+    """ Convert a YYYY-MM-DD HH:MM:SS timestamp to seconds since the epoch. The seconds for each
+        date are cached since a log's timestamps share a handful of dates. """
+    if not timestamp:
+        return 0
+    date = timestamp[:10]
+    if date not in days:
+        days[date] = calendar.timegm(time.strptime(date, "%Y-%m-%d"))
+    return (days[date]
+        + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19]))
+
+
+def decode_timestamp(seconds):
+    if not seconds:
+        return None
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+
+
+def shared_prefix_length(a, b):
+    """ Return the length of the common prefix of two strings, bisecting on slice comparisons
+        rather than comparing character by character. """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def write_processed_log(path, records):
+    """ Write (timestamp, uframe_route, filename) records to a processed log in the compact format.
+        Only the first of any duplicate records is kept. The file is written under a temporary name
+        and renamed into place, so readers never see a partially written file. """
+    routes = {}
+    entries = {}
+    for timestamp, uframe_route, filename in records:
+        key = (filename, routes.setdefault(uframe_route, len(routes)))
+        if key not in entries:
+            entries[key] = encode_timestamp(timestamp)
+
+    parts = []
+    restarts = []
+    position = 0
+    previous = ""
+    for i, key in enumerate(sorted(entries)):
+        filename, route_number = key
+        shared = 0
+        if i % RESTART_INTERVAL:
+            shared = shared_prefix_length(previous, filename)
+        else:
+            restarts.append(OFFSET.pack(position))
+        suffix = filename[shared:]
+        parts.append(ENTRY.pack(shared, len(suffix), route_number, entries[key]))
+        parts.append(suffix)
+        position += ENTRY.size + len(suffix)
+        previous = filename
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as outfile:
+        outfile.write(HEADER.pack(
+            MAGIC, VERSION, RESTART_INTERVAL, len(routes), len(entries), len(restarts)))
+        for uframe_route in sorted(routes, key=routes.get):
+            outfile.write(ROUTE_LENGTH.pack(len(uframe_route)))
+            outfile.write(uframe_route)
+        outfile.writelines(restarts)
+        outfile.writelines(parts)
+    os.rename(temporary_path, path)
+    return len(entries)
+
+
+def convert_processed_log(path):
+    """ Rewrite a processed log written before the compact format, which holds a plain copy of
+        the log's "Finished Processing file" lines, in the compact format. """
+    return write_processed_log(path, list(LogReader(path).records()))
+
+
+class ProcessedLog(object):
+    """ A memory-mapped processed log in the compact format. Lookups bisect the restart table, so
+        they only touch a handful of pages, and concurrent ingest processes reading the same
+        processed log share its pages in the page cache. """
+
+    def __init__(self, path):
+        self.path = path
+        with open(self.path, "rb") as infile:
+            self.data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.restart_interval, route_count, self.entry_count, self.restart_count
+            ) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            self.data.close()
+            raise ValueError("%s is not a processed log in the compact format." % self.path)
+
+        position = HEADER.size
+        self.routes = []
+        for i in range(route_count):
+            length = ROUTE_LENGTH.unpack_from(self.data, position)[0]
+            position += ROUTE_LENGTH.size
+            self.routes.append(self.data[position:position + length])
+            position += length
+        self.route_numbers = dict((route, i) for i, route in enumerate(self.routes))
+        self.restarts_offset = position
+        self.entries_offset = position + self.restart_count * OFFSET.size
+
+    def close(self):
+        self.data.close()
+
+    def restart(self, i):
+        """ Return the position of the entry at the i-th restart point. """
+        return self.entries_offset + OFFSET.unpack_from(
+            self.data, self.restarts_offset + i * OFFSET.size)[0]
+
+    def entries(self, position=None):
+        """ Yield (filename, route number, timestamp seconds) for each entry, starting at the
+            position of a restart point (or the first entry). """
+        position = self.entries_offset if position is None else position
+        end = len(self.data)
+        filename = ""
+        while position < end:
+            shared, length, route_number, seconds = ENTRY.unpack_from(self.data, position)
+            position += ENTRY.size
+            filename = filename[:shared] + self.data[position:position + length]
+            position += length
+            yield filename, route_number, seconds
+
+    def seek(self, filename):
+        """ Return the position of the last restart point before any entry for the filename. """
+        low, high = 0, self.restart_count
+        while low < high:
+            middle = (low + high) // 2
+            position = self.restart(middle)
+            length = ENTRY.unpack_from(self.data, position)[1]
+            start = position + ENTRY.size
+            if self.data[start:start + length] < filename:
+                low = middle + 1
+            else:
+                high = middle
+        return self.restart(low - 1) if low else self.entries_offset
+
+    def contains(self, uframe_route, filename):
+        """ Check if the log shows EDEX finished processing the file for the uframe_route. The
+            Ingestor's duplicate checks go through the IngestedFileIndex instead, which covers
+            every log at once. """
+        route_number = self.route_numbers.get(uframe_route)
+        if route_number is None or not self.entry_count:
+            return False
+        for entry_filename, entry_route_number, seconds in self.entries(self.seek(filename)):
+            if entry_filename > filename:
+                return False
+            if entry_filename == filename and entry_route_number == route_number:
+                return True
+        return False
+
+    def records(self, prefix=""):
+        """ Yield a (timestamp, uframe_route, filename) tuple for each entry, optionally limited
+            to filenames starting with the prefix. """
+        if not self.entry_count:
+            return
+        for filename, route_number, seconds in self.entries(self.seek(prefix)):
+            if filename.startswith(prefix):
+                yield decode_timestamp(seconds), self.routes[route_number], filename
+            elif filename > prefix:
+                return
@@ -0,0 +1,139 @@
+import time
+import logging
+import threading
+import multiprocessing
+
+from jobs_config import JobsConfig, JOBS_CONFIG_FILE
+
+# The most route limits whose buckets are shared by all the sending processes.
+SHARED_ROUTE_BUCKETS = 256
+
+
+class TokenBucket(object):
+    """ A token bucket holding up to burst tokens that refills at rate tokens per second, kept
+        in state (which may be in shared memory). """
+
+    def __init__(self, rate, burst=None, state=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.state = [0.0, 0.0] if state is None else state
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.state[0] = tokens
+
+    @property
+    def updated(self):
+        return self.state[1]
+
+    @updated.setter
+    def updated(self, updated):
+        self.state[1] = updated
+
+    def configure(self, rate, burst=None):
+        """ Change the rate and burst size, keeping the tokens already in the bucket. """
+        self.refill()
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = min(self.tokens, self.burst)
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """ Return how long it will be until a token is available. """
+        self.refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+
+class RateLimiter(object):
+    """ Global and per uframe_route limits on the rate messages are sent at, read from the
+        RATE_LIMITS section of the jobs config file and shared by forked sender processes. """
+
+    def __init__(self, config_file=JOBS_CONFIG_FILE):
+        self.logger = logging.getLogger('RateLimiter')
+        self.jobs_config = JobsConfig(config_file)
+        self.lock = threading.RLock()
+        self.shared_lock = multiprocessing.Lock()
+        self.states = [multiprocessing.RawArray('d', 2) for i in range(SHARED_ROUTE_BUCKETS + 1)]
+        self.global_bucket = None
+        self.route_buckets = {}
+        self.reload()
+
+    def bucket(self, bucket, limit, state=None):
+        """ Return a token bucket for a {rate, burst} limit kept in state, reconfiguring the
+            existing bucket if there is one, or None if the limit isn't set. """
+        if not limit or not limit.get('rate') or limit['rate'] <= 0:
+            return None
+        if bucket is None:
+            return TokenBucket(limit['rate'], limit.get('burst'), state)
+        with self.shared_lock:
+            if state is not None:
+                bucket.state = state
+            bucket.configure(limit['rate'], limit.get('burst'))
+        return bucket
+
+    def reload(self):
+        """ Read the rate limits again if the jobs config file has changed since they were read. """
+        with self.lock:
+            self.reload_limits()
+
+    def reload_limits(self):
+        if not self.jobs_config.reload():
+            return
+        limits = self.jobs_config.get('RATE_LIMITS', {})
+
+        self.global_bucket = self.bucket(self.global_bucket, limits.get('GLOBAL'), self.states[0])
+        routes = limits.get('ROUTES') or {}
+        if len(routes) > SHARED_ROUTE_BUCKETS:
+            self.logger.warning(
+                "Only the first %s route limits are shared by the sending processes." % (
+                    SHARED_ROUTE_BUCKETS))
+        route_buckets = {}
+        for i, route in enumerate(sorted(routes)):
+            bucket = self.bucket(
+                self.route_buckets.get(route), routes[route],
+                self.states[i + 1] if i < SHARED_ROUTE_BUCKETS else None)
+            if bucket:
+                route_buckets[route] = bucket
+        self.route_buckets = route_buckets
+        if self.limited():
+            self.logger.info("Rate limits loaded from %s: %s global, %s route(s)." % (
+                self.jobs_config.config_file,
+                "%s/s" % self.global_bucket.rate if self.global_bucket else "no limit",
+                len(self.route_buckets)))
+
+    def limited(self):
+        """ Check if any rate limits are set. """
+        self.reload()
+        return self.global_bucket is not None or bool(self.route_buckets)
+
+    def wait(self, uframe_route):
+        """ Wait until a message can be sent to the uframe_route within the global limit and the
+            route's limit, then count it against both. Returns the time spent waiting. """
+        waited = 0
+        while True:
+            with self.lock:
+                self.reload_limits()
+                buckets = [
+                    b for b in (self.global_bucket, self.route_buckets.get(uframe_route)) if b]
+                with self.shared_lock:
+                    delay = max([b.delay() for b in buckets] or [0])
+                    if not delay:
+                        for b in buckets:
+                            b.take()
+                        return waited
+            time.sleep(delay)
+            waited += delay
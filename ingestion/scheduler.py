@@ -0,0 +1,220 @@
+import time
+import logging
+import threading
+
+from fnmatch import fnmatch
+from collections import OrderedDict
+
+from jobs_config import JobsConfig, JOBS_CONFIG_FILE
+
+SHARE_FIELDS = ('deployment_number', 'uframe_route', 'data_source', 'mask')
+
+
+class Flow(object):
+    """ The files of one batch that are still waiting to be sent. """
+
+    def __init__(self, number, batch):
+        self.number = number
+        self.batch = batch
+        self.files = batch['files']
+        self.routes = self.files[0][1] if self.files else []
+        self.share = None
+        self.in_flight = 0
+        self.held_routes = set()
+
+    def values(self, field):
+        """ Return the batch's values of one of the SHARE_FIELDS. """
+        if field in ('deployment_number', 'mask'):
+            return [str(self.batch[field])]
+        return sorted(set(r[field] for r in self.routes))
+
+
+class BatchScheduler(object):
+    """ Hands out the Ingestor's batches, in chunks, by the priority classes and fair shares in
+        the SCHEDULER section of the jobs config file. Threads can share it; get waits for a chunk
+        to be ready, and, while the scheduler is open, for more batches to be added. """
+
+    def __init__(self, config_file=JOBS_CONFIG_FILE, stopping=None, chunk_size=None,
+            ordered=True):
+        self.logger = logging.getLogger('Scheduler')
+        self.jobs_config = JobsConfig(config_file)
+        self.stopping = stopping or threading.Event()
+        self.chunk_size = chunk_size or None
+        self.ordered = ordered
+        self.condition = threading.Condition(threading.RLock())
+        self.is_open = False
+        self.flows = []
+        self.in_flight = {}
+        self.flow_count = 0
+        self.chunk_count = 0
+
+        self.quantum = None
+        self.share_by = ('deployment_number', )
+        self.weights = {}
+        self.classes = []
+        self.shares = [OrderedDict()]
+        self.reload()
+
+    def __len__(self):
+        """ Return the number of batches with files waiting to be sent. """
+        with self.condition:
+            return len(self.flows)
+
+    def reload(self):
+        """ Read the schedule again if the jobs config file has changed since it was read, and
+            reschedule the waiting batches. """
+        if not self.jobs_config.reload():
+            return
+        schedule = self.jobs_config.get('SCHEDULER', {})
+
+        self.quantum = schedule.get('QUANTUM') or None
+        self.share_by = tuple(
+            f for f in (schedule.get('SHARE_BY') or ('deployment_number', ))
+            if f in SHARE_FIELDS)
+        self.weights = schedule.get('WEIGHTS') or {}
+        self.classes = schedule.get('CLASSES') or []
+        self.shares = [OrderedDict() for c in range(len(self.classes) + 1)]
+        for flow in self.flows:
+            self.schedule(flow)
+        if self.classes or self.quantum:
+            self.logger.info(
+                "Schedule loaded from %s: %s priority classes, %s files per turn." % (
+                    self.jobs_config.config_file, len(self.classes), self.quantum or "all"))
+
+    def matches(self, flow, rule):
+        """ Check if a batch matches all the conditions of a priority class. """
+        for field in ('data_source', 'uframe_route', 'mask'):
+            patterns = rule.get(field)
+            if patterns is None:
+                continue
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+            if not any(fnmatch(v, str(p)) for v in flow.values(field) for p in patterns):
+                return False
+        if rule.get('max_age') is not None:
+            newest = flow.batch.get('newest')
+            if not newest or time.time() - newest > rule['max_age']:
+                return False
+        return True
+
+    def priority(self, flow):
+        for i, rule in enumerate(self.classes):
+            if self.matches(flow, rule or {}):
+                return i
+        return len(self.classes)
+
+    def schedule(self, flow):
+        """ Add a batch to the back of its share, adding the share to the back of its class. """
+        key = tuple(tuple(flow.values(field)) for field in self.share_by)
+        flow.share = (self.priority(flow), key)
+        self.shares[flow.share[0]].setdefault(flow.share[1], []).append(flow)
+
+    def weight(self, key):
+        weights = [self.weights[v] for values in key for v in values if v in self.weights]
+        return max(weights) if weights else 1
+
+    def append(self, batch):
+        with self.condition:
+            self.flow_count += 1
+            flow = Flow(self.flow_count, batch)
+            self.flows.append(flow)
+            self.schedule(flow)
+            self.condition.notify_all()
+
+    def take(self, flow):
+        """ Hand out the next chunk of a batch's files. """
+        priority, key = flow.share
+        sizes = [self.chunk_size]
+        if self.quantum:
+            sizes.append(max(int(self.quantum * self.weight(key)), 1))
+        count = min(s for s in sizes if s) if any(sizes) else len(flow.files)
+        files, flow.files = flow.files[:count], flow.files[count:]
+        if not flow.files:
+            flows = self.shares[priority][key]
+            flows.remove(flow)
+            if not flows:
+                del self.shares[priority][key]
+            self.flows.remove(flow)
+
+        self.chunk_count += 1
+        flow.in_flight += 1
+        self.in_flight[self.chunk_count] = flow
+        return dict(
+            flow.batch, files=files, chunk=self.chunk_count, held_routes=sorted(flow.held_routes))
+
+    def next_batch(self):
+        """ Take the next chunk of a batch to send, or return None if every waiting batch has a
+            chunk being sent (and none can be stolen). """
+        for shares in self.shares:
+            for key in shares.keys():
+                flow = next((f for f in shares[key] if not f.in_flight), None)
+                if flow is None:
+                    continue
+                # Give the share its turn and move it to the back of its class.
+                shares[key] = shares.pop(key)
+                return self.take(flow)
+
+        # Steal from the batch in the highest priority class with the most files left.
+        if not self.ordered and self.flows:
+            flow = max(self.flows, key=lambda f: (-f.share[0], len(f.files)))
+            self.logger.debug("Stealing a chunk of %s (%s files left)." % (
+                flow.batch['mask'], len(flow.files)))
+            return self.take(flow)
+        return None
+
+    def get(self):
+        """ Return the next batch (or part of a batch) to send, waiting if the rest are being sent
+            or, while the scheduler is open, for more to be added. Returns None once there are
+            no more batches to send, or when ingestion is stopping. """
+        with self.condition:
+            while not self.stopping.is_set():
+                self.reload()
+                batch = self.next_batch()
+                if batch is not None:
+                    self.condition.notify_all()
+                    return batch
+                if not self.flows and not self.is_open:
+                    return None
+                self.condition.wait(1)
+            return None
+
+    def done(self, batch, failed_routes=(), failed=False):
+        """ Let the rest of the batch be sent once a chunk of it has been sent. The routes the
+            chunk failed on (all of its routes, if failed) are held: the later chunks of the batch
+            are handed out with them as held_routes, and don't raise their high water marks. """
+        if failed:
+            failed_routes = [
+                r['uframe_route'] for data_file, routes in batch['files'] for r in routes]
+        with self.condition:
+            flow = self.in_flight.pop(batch.get('chunk'), None)
+            if flow is not None:
+                flow.in_flight -= 1
+                flow.held_routes.update(failed_routes)
+                self.condition.notify_all()
+
+    def drain(self):
+        """ Remove and return the batches (or what is left of them) still waiting to be sent. """
+        with self.condition:
+            batches = [dict(flow.batch, files=flow.files) for flow in self.flows]
+            self.flows = []
+            self.shares = [OrderedDict() for shares in self.shares]
+            self.condition.notify_all()
+            return batches
+
+    def open(self):
+        """ Keep get waiting for more batches while they are being added. """
+        with self.condition:
+            self.is_open = True
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+    def wait_for_room(self, size, timeout):
+        """ Wait up to timeout seconds until fewer than size batches are waiting. Returns True if
+            there is room for another batch. """
+        with self.condition:
+            if len(self.flows) >= size:
+                self.condition.wait(timeout)
+            return len(self.flows) < size